@@ -7,22 +7,30 @@
 #----------------------
 
 
+import asyncio
 import base64
+import difflib
+import hashlib
 import io
 import json
+import math
+import multiprocessing
 import os
+import queue
 import re
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
 
 import fitz  # PyMuPDF
+import httpx
 import ollama
-import requests
 import soundfile as sf
-import whisper
-from flask import Flask, jsonify, render_template_string, request, Response, session
+from flask import Flask, jsonify, render_template_string, request, Response, send_from_directory
 from flask_socketio import SocketIO
 from kokoro_onnx import Kokoro
 from PIL import Image
@@ -34,29 +42,139 @@ from urllib.parse import urlparse
 # Ollama model
 DEFAULT_OLLAMA_MODEL = "gemma3:4b"
 
+# LLM backend: "ollama" (default) or "openai" for a local OpenAI-compatible server such as llama.cpp's llama-server.
+# Set with the LLM_BACKEND and OPENAI_BASE_URL environment variables. The server must be on localhost.
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama").strip().lower()
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "http://127.0.0.1:8080/v1").strip()
+
+# Model discovery: the installed models are listed at start-up and then refreshed in the background
+MODEL_REFRESH_INTERVAL = 30 # Seconds between refreshes of the model list
+MODEL_LIST_TIMEOUT = 2 # Seconds to wait for the model list
+
+# HTTP connection pool shared by all calls to the LLM backend (one pool for sync calls, one for streaming)
+HTTP_MAX_CONNECTIONS = 8
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 8
+HTTP_KEEPALIVE_EXPIRY = 300 # Seconds an idle connection is kept open
+HTTP_CONNECT_TIMEOUT = 5 # Seconds
+HTTP_READ_TIMEOUT = 600 # Seconds without data before a request fails (a long non-streamed reply)
+
+# Backend health: a background check pings the backend, and a circuit breaker fails new turns at once
+# while it is down instead of letting them hang until the HTTP timeout
+HEALTH_CHECK_INTERVAL = 5 # Seconds between pings
+HEALTH_CHECK_TIMEOUT = 2 # Seconds to wait for a ping
+BREAKER_FAILURE_THRESHOLD = 2 # Failed pings or calls in a row before new turns are turned away
+BREAKER_OPEN_SECONDS = 15 # Minimum time turns are turned away before a trial turn is let through
+BACKEND_RESPONSE_TIMEOUT = 180 # Seconds to wait for the first chunk of a reply (a cold model load included)
+
+# Model routing: short text-only turns can go to a smaller, faster model (the "fast_model" setting).
+# Turns with images, long prompts or any of the keywords stay on the selected model.
+DEFAULT_ROUTING_RULES = {
+    "max_fast_chars": 200,
+    "main_model_keywords": ["explain", "why", "how does", "compare", "analyze", "analyse", "summarize", "summarise",
+                            "code", "calculate", "step by step", "translate", "write"]
+}
+
+# How long Ollama keeps the model in memory after a request: "5m", "30m", "2h", or "-1" (forever)
+DEFAULT_KEEP_ALIVE = "30m"
+
+# Generation scheduler: replies from all open tabs share Ollama's parallel slots
+GENERATION_SLOTS = int(os.environ.get("OLLAMA_NUM_PARALLEL") or 1) # Replies generated at the same time (match Ollama's OLLAMA_NUM_PARALLEL)
+GENERATION_MAX_WAIT = 30 # Seconds. A reply that would wait longer than this in the queue is turned away.
+GENERATION_INITIAL_ESTIMATE = 8 # Seconds per reply, used for wait estimates until replies have been timed
+BACKGROUND_SLOT_POLL = 1 # Seconds between tries of a caption or summary waiting for a free slot
+
+# Tokens are sent to the browser in batches instead of one socket message per token
+TOKEN_FLUSH_MS = 50 # A batch is sent at most this often (the "token_flush_ms" setting overrides it)
+TOKEN_FLUSH_CHARS = 200 # ...or as soon as it holds this many characters
+
+# Per-turn metrics, reported in chat_end, saved with the reply and summarized at /metrics
+COLD_LOAD_THRESHOLD_MS = 500 # A load_duration above this means the model had to be loaded for the turn
+TURN_METRICS_HISTORY = 500 # Recent turns kept for /metrics
+
+# Response cache (opt-in): replies to repeated prompts are replayed instead of generated again.
+# Used when the "response_cache" setting is On and the temperature is 0 or the request is marked cacheable.
+# "cacheable" is API-only: the UI never sets it, but a client can send "cacheable": true with chat_message.
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024 # Cached replies and their audio
+RESPONSE_CACHE_MAX_AGE = 24 * 60 * 60 # Seconds
+
 # LLM Parameters
 DEFAULT_NUM_CTX = 8000
 DEFAULT_TEMPERATURE = 1.0
 DEFAULT_TOP_P = 0.95
 
+# Context management: older history is trimmed so the prompt fits in a share of num_ctx
+DEFAULT_CONTEXT_POLICY = "sliding_window" # sliding_window, pin_first, summary
+CONTEXT_BUDGET_FRACTION = 0.75 # Share of num_ctx available for the prompt. The rest is left for the reply.
+CHARS_PER_TOKEN = 3.5 # Token estimate (Ollama has no tokenize endpoint)
+IMAGE_TOKEN_ESTIMATE = 256 # Gemma 3 encodes each image as 256 tokens
+MESSAGE_TOKEN_OVERHEAD = 4 # Role markers added by the chat template
+CONTEXT_TRIM_STEP = 6 # Messages are dropped in blocks so the prompt prefix (and Ollama's cache) changes less often
+CONTEXT_PINNED_MESSAGES = 2 # Messages kept from the start of the chat by the pin_first policy
+SUMMARY_MAX_TOKENS = 300 # Length limit of the rolling summary used by the summary policy
+
+# Images in older turns are replaced by a caption so they aren't re-encoded on every turn
+DEFAULT_IMAGE_TURNS = "2" # Number of recent user turns that keep their full images ("all" keeps every image)
+CAPTION_MAX_TOKENS = 200
+IMAGE_CAPTION_PROMPT = ("Describe this image in detail for someone who cannot see it. Include any text, numbers, "
+                        "tables and charts it contains. Reply with the description only.")
+
 DEFAULT_SYSTEM_MESSAGE = "You are emulating Samantha from the movie 'Her.' Your responses are being converted into audio by a TTS system.  Focus on creating responses that sound great when read aloud. Keep your sentences clear and prioritize natural-sounding language. Do not use emojis or markdown. Speak naturally. Do not end responses with a question unless it fits the conversation flow. When the user uses voice input it gets transcribed by an STT system. STT transcripts may contain errors. Be understanding of potential transcription mistakes."
 
 # Store user settings
 SETTINGS_FILE = "user_settings.json"
 CONVERSATIONS_FILE = "voice_assistant_history.json"
+IMAGE_STORE_DIR = "image_store" # Uploaded images, stored once under their content hash
 
 # PDF & Image Settings
 MAX_PAGES = 15
 PDF_IMAGE_RES = 1.5 # 150 dpi
 MAX_UPLOAD_FILE_SIZE = 20 * 1024 * 1024 # (20MB)
+IMAGE_CACHE_SIZE = 64 # Base64-encoded images kept in memory for building prompts
 
 # STT Model
-WHISPER_MODEL = "base" # base, tiny.en
+WHISPER_MODEL = "base" # Default model size: base, tiny.en
+WHISPER_MODEL_SIZES = ["tiny.en", "tiny", "base.en", "base", "small.en", "small"]
+WHISPER_MAX_LOADED_MODELS = 2 # Models kept in memory. The least recently used one is unloaded first.
+
+# STT Worker Processes
+STT_WORKER_PROCESSES = 1 # Each worker process transcribes one request at a time
+STT_MAX_QUEUED_REQUESTS = 4 # Requests waiting for a free worker. Further requests get a 503 (busy) response.
+STT_REQUEST_TIMEOUT = 120 # Seconds
+STT_BATCH_WINDOW_MS = 20 # Requests arriving within this window are transcribed together in one batch
+STT_MAX_BATCH_SIZE = 4
+
+# Two-pass STT: a small model produces a draft transcript that starts the reply early
+WHISPER_DRAFT_MODEL = "tiny" # tiny.en is used when the language is English
+DRAFT_STT_PROFILE = "fast"
+TWO_PASS_MIN_SIMILARITY = 0.85 # Word-level similarity needed to keep the reply generated from the draft
+
+# STT latency profiles (Whisper decode settings). These are saved to user_settings.json and can be edited there.
+# temperature: fallback ladder. Whisper re-decodes at the next temperature if the output looks wrong.
+# beam_size: None means greedy decoding. without_timestamps: skip timestamp token prediction.
+DEFAULT_STT_PROFILE = "balanced"
+DEFAULT_STT_PROFILES = {
+    "fast": {
+        "beam_size": None, "temperature": [0.0], "condition_on_previous_text": False, "without_timestamps": True,
+        "no_speech_threshold": 0.6, "logprob_threshold": -1.0, "compression_ratio_threshold": 2.4
+    },
+    "balanced": {
+        "beam_size": None, "temperature": [0.0, 0.4, 0.8], "condition_on_previous_text": False, "without_timestamps": True,
+        "no_speech_threshold": 0.6, "logprob_threshold": -1.0, "compression_ratio_threshold": 2.4
+    },
+    "accurate": {
+        "beam_size": 5, "best_of": 5, "temperature": [0.0, 0.2, 0.4, 0.6, 0.8, 1.0], "condition_on_previous_text": True,
+        "without_timestamps": False, "no_speech_threshold": 0.6, "logprob_threshold": -1.0, "compression_ratio_threshold": 2.4
+    }
+}
 
 
 
 # --- Initialization ---
 
+# Whisper runs in separate worker processes (see "Whisper Worker Processes" below). A worker re-imports
+# this file when it starts, so the server-only initialization is skipped inside the workers.
+IS_STT_WORKER = multiprocessing.current_process().name != "MainProcess"
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_FILE_SIZE
 app.config['SECRET_KEY'] = 'dummy_secret_key' # Required for SocketIO # your_super_secret_key_change_me'
@@ -67,43 +185,244 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 # PRIVACY FEATURE: Make sure that the app only connects to localhost.
 # -----------------------------------------
 current_ollama_host = os.environ.get("OLLAMA_HOST", "").strip()
-print(f"Current Ollama host: {current_ollama_host!r}")
+if not IS_STT_WORKER: print(f"Current Ollama host: {current_ollama_host!r}")
 
-def is_localhost_url(url):
+def is_localhost_url(url, required_port=11434):
+    # required_port=None accepts any port on localhost
     if not url: return True
     parsed = urlparse(url if "://" in url else "http://" + url)
     hostname = parsed.hostname
     port = parsed.port or 11434
-    return hostname in ("127.0.0.1", "localhost") and port == 11434
+    return hostname in ("127.0.0.1", "localhost") and (required_port is None or port == required_port)
 
 if not is_localhost_url(current_ollama_host):
     print(f"[SECURITY] OLLAMA_HOST is not localhost: {current_ollama_host}. Aborting start.", file=sys.stderr)
     sys.exit(1)
 
+if LLM_BACKEND not in ("ollama", "openai"):
+    print(f"[ERROR] Unknown LLM_BACKEND: {LLM_BACKEND!r}. Use 'ollama' or 'openai'.", file=sys.stderr)
+    sys.exit(1)
+
+if LLM_BACKEND == "openai" and not is_localhost_url(OPENAI_BASE_URL, required_port=None):
+    print(f"[SECURITY] OPENAI_BASE_URL is not localhost: {OPENAI_BASE_URL}. Aborting start.", file=sys.stderr)
+    sys.exit(1)
+
 
 # Check for Kokoro model files
 KOKORO_ONNX_FILE = "kokoro-v1.0.onnx"
 KOKORO_VOICES_FILE = "voices-v1.0.bin"
 
-if not os.path.exists(KOKORO_ONNX_FILE) or not os.path.exists(KOKORO_VOICES_FILE):
-    print(f"[ERROR] Kokoro model files not found. Please download them.", file=sys.stderr)
-    sys.exit(1)
+if not IS_STT_WORKER:
+    if not os.path.exists(KOKORO_ONNX_FILE) or not os.path.exists(KOKORO_VOICES_FILE):
+        print(f"[ERROR] Kokoro model files not found. Please download them.", file=sys.stderr)
+        sys.exit(1)
 
-try:
-    print("[INFO] Loading Kokoro text-to-speech engine...")
-    kokoro = Kokoro(KOKORO_ONNX_FILE, KOKORO_VOICES_FILE)
-    print("[INFO] Kokoro engine loaded successfully.")
-except Exception as e:
-    print(f"[ERROR] Failed to load Kokoro engine: {e}", file=sys.stderr)
-    sys.exit(1)
+    try:
+        print("[INFO] Loading Kokoro text-to-speech engine...")
+        kokoro = Kokoro(KOKORO_ONNX_FILE, KOKORO_VOICES_FILE)
+        print("[INFO] Kokoro engine loaded successfully.")
+    except Exception as e:
+        print(f"[ERROR] Failed to load Kokoro engine: {e}", file=sys.stderr)
+        sys.exit(1)
     
-try:
-    print(f"[INFO] Loading Whisper STT model ({WHISPER_MODEL})...")
-    whisper_model = whisper.load_model(WHISPER_MODEL)
-    print("[INFO] Whisper model loaded successfully.")
-except Exception as e:
-    print(f"[ERROR] Failed to load Whisper model: {e}", file=sys.stderr)
-    sys.exit(1)
+
+# --- Whisper Model Pool ---
+# Whisper models are loaded the first time they are requested and kept in memory
+# (up to WHISPER_MAX_LOADED_MODELS). This lets the user switch model size without a restart.
+# The pool lives inside the STT worker processes.
+whisper_models = OrderedDict()
+whisper_models_lock = threading.Lock()
+whisper_load_locks = {}
+
+def get_whisper_model(name):
+    if name not in WHISPER_MODEL_SIZES: name = WHISPER_MODEL
+    with whisper_models_lock:
+        if name in whisper_models:
+            whisper_models.move_to_end(name)
+            return whisper_models[name]
+        load_lock = whisper_load_locks.setdefault(name, threading.Lock())
+    # Only requests for this model size wait while it loads
+    with load_lock:
+        with whisper_models_lock:
+            if name in whisper_models: return whisper_models[name]
+        import whisper # Only imported by the STT worker processes
+        print(f"[INFO] Loading Whisper STT model ({name})...")
+        model = whisper.load_model(name)
+        with whisper_models_lock:
+            whisper_models[name] = model
+            while len(whisper_models) > WHISPER_MAX_LOADED_MODELS:
+                evicted_name, _ = whisper_models.popitem(last=False)
+                print(f"[INFO] Unloaded Whisper model ({evicted_name}).")
+        print(f"[INFO] Whisper model ({name}) loaded successfully.")
+        return model
+
+
+# --- Whisper Worker Processes ---
+# Transcription runs in separate processes so that a Whisper decode does not compete with token
+# streaming and TTS for the server's Python interpreter. Each worker has a dispatcher thread in the
+# server that takes jobs from a bounded queue and sends the audio to the worker over a pipe.
+stt_job_queue = queue.Queue(maxsize=STT_MAX_QUEUED_REQUESTS)
+
+def load_job_audio(job):
+    # Decodes the uploaded recording to 16 kHz mono samples (Whisper uses ffmpeg, which needs a file)
+    import whisper
+    fd, temp_audio_path = tempfile.mkstemp(suffix=".wav")
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(job["audio"])
+        return whisper.load_audio(temp_audio_path)
+    finally:
+        if os.path.exists(temp_audio_path): os.remove(temp_audio_path)
+
+def finish_transcript(text, audio_seconds, load_time, transcribe_time, batch_size=1):
+    text = text.strip()
+    if has_repeated_phrases(text) or contains_mixed_scripts(text): text = ""
+    return {"text": text, "audio_seconds": audio_seconds, "load_time": load_time, "transcribe_time": transcribe_time, "batch_size": batch_size}
+
+def transcribe_job(job, audio=None):
+    # Runs inside a worker process. job: {"audio": bytes, "model": name, "options": whisper options}
+    try:
+        if audio is None: audio = load_job_audio(job)
+        start_time = time.perf_counter()
+        whisper_model = get_whisper_model(job["model"])
+        load_time = time.perf_counter() - start_time
+        result = whisper_model.transcribe(audio, **job["options"])
+        transcribe_time = time.perf_counter() - start_time - load_time
+        audio_seconds = result["segments"][-1]["end"] if result.get("segments") else 0.0
+        return finish_transcript(result["text"], audio_seconds, load_time, transcribe_time)
+    except Exception as e:
+        return {"error": str(e)}
+
+def transcribe_batch(jobs, send_result):
+    # Runs inside a worker process. Recordings that use the same model and decode options and fit in one
+    # 30 second Whisper window are padded into one mel batch and decoded together. Everything else, and
+    # any batch result that fails Whisper's quality thresholds, goes through the normal transcribe path.
+    # Smaller models run first and each result is sent as soon as it is ready, so a two-pass draft
+    # transcript is not held up by the full model.
+    import torch
+    import whisper
+    groups = {}
+    model_order = lambda i: WHISPER_MODEL_SIZES.index(jobs[i]["model"]) if jobs[i]["model"] in WHISPER_MODEL_SIZES else 0
+    for i in sorted(range(len(jobs)), key=model_order):
+        job = jobs[i]
+        try: audio = load_job_audio(job)
+        except Exception as e:
+            send_result(i, {"error": str(e)})
+            continue
+        if len(audio) > whisper.audio.N_SAMPLES: key = ("long", i)
+        else: key = (job["model"], json.dumps(job["options"], sort_keys=True))
+        groups.setdefault(key, []).append((i, audio))
+
+    for key, members in groups.items():
+        if len(members) == 1:
+            i, audio = members[0]
+            send_result(i, transcribe_job(jobs[i], audio))
+            continue
+        model_name = key[0]
+        options = jobs[members[0][0]]["options"]
+        try:
+            start_time = time.perf_counter()
+            whisper_model = get_whisper_model(model_name)
+            load_time = time.perf_counter() - start_time
+            mels = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), whisper_model.dims.n_mels) for _, audio in members
+            ]).to(whisper_model.device)
+            temperatures = options.get("temperature", (0.0,))
+            temperature = temperatures[0] if isinstance(temperatures, (list, tuple)) else temperatures
+            decode_options = whisper.DecodingOptions(
+                language=options.get("language"), temperature=temperature, fp16=options.get("fp16", False),
+                without_timestamps=options.get("without_timestamps", False),
+                beam_size=options.get("beam_size") if temperature == 0 else None,
+                best_of=options.get("best_of") if temperature > 0 else None
+            )
+            decoded = whisper.decode(whisper_model, mels, decode_options)
+            transcribe_time = time.perf_counter() - start_time - load_time
+        except Exception as e:
+            print(f"[WARNING] Batched transcription failed, transcribing one by one: {e}", file=sys.stderr)
+            for i, audio in members: send_result(i, transcribe_job(jobs[i], audio))
+            continue
+        compression_threshold = options.get("compression_ratio_threshold")
+        logprob_threshold = options.get("logprob_threshold")
+        no_speech_threshold = options.get("no_speech_threshold")
+        for (i, audio), result in zip(members, decoded):
+            low_logprob = logprob_threshold is not None and result.avg_logprob < logprob_threshold
+            confident = logprob_threshold is not None and result.avg_logprob > logprob_threshold
+            if no_speech_threshold is not None and result.no_speech_prob > no_speech_threshold and not confident:
+                text = ""
+            elif (compression_threshold is not None and result.compression_ratio > compression_threshold) or low_logprob:
+                send_result(i, transcribe_job(jobs[i], audio)) # Let transcribe() apply the temperature fallback
+                continue
+            else:
+                text = result.text
+            send_result(i, finish_transcript(text, len(audio) / whisper.audio.SAMPLE_RATE, load_time, transcribe_time, len(members)))
+
+def stt_worker_main(conn, preload_model):
+    # Entry point of a worker process. Receives a list of jobs and replies with one (index, result)
+    # message per job, followed by None when the whole batch is done.
+    try:
+        get_whisper_model(preload_model)
+        conn.send({"ready": True})
+    except Exception as e:
+        conn.send({"ready": False, "error": str(e)})
+        return
+    while True:
+        try: jobs = conn.recv()
+        except EOFError: break
+        if jobs is None: break
+        transcribe_batch(jobs, lambda i, result: conn.send((i, result)))
+        conn.send(None)
+
+def start_stt_worker(index, preload_model):
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=stt_worker_main, args=(child_conn, preload_model), name=f"stt-worker-{index}", daemon=True)
+    process.start()
+    child_conn.close()
+    try: status = parent_conn.recv()
+    except EOFError: status = {"ready": False, "error": "Worker process exited during start-up."}
+    if not status.get("ready"):
+        process.join(timeout=1)
+        raise RuntimeError(status.get("error"))
+    return process, parent_conn
+
+def collect_stt_batch():
+    # Waits for a job, then keeps collecting jobs that arrive within STT_BATCH_WINDOW_MS
+    batch = [stt_job_queue.get()]
+    deadline = time.monotonic() + STT_BATCH_WINDOW_MS / 1000
+    while len(batch) < STT_MAX_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try: batch.append(stt_job_queue.get(timeout=remaining) if remaining > 0 else stt_job_queue.get_nowait())
+        except queue.Empty: break
+    return batch
+
+def stt_dispatcher(index, process, conn, preload_model):
+    # Server-side thread that feeds one worker process. A crashed worker is restarted for the next batch.
+    while True:
+        batch = collect_stt_batch()
+        try:
+            if process is None or not process.is_alive():
+                print(f"[WARNING] Restarting STT worker {index}.", file=sys.stderr)
+                process, conn = start_stt_worker(index, preload_model)
+            conn.send([{"audio": job["audio"], "model": job["model"], "options": job["options"]} for job in batch])
+            while (message := conn.recv()) is not None:
+                i, result = message
+                batch[i]["result"] = result
+                batch[i]["done"].set()
+        except Exception as e:
+            print(f"[ERROR] STT worker {index} failed: {e}", file=sys.stderr)
+            for job in batch:
+                if job["result"] is None: job["result"] = {"error": "Speech recognition worker failed."}
+            if process is not None and process.is_alive(): process.kill()
+            process = None
+        finally:
+            for job in batch:
+                if job["result"] is None: job["result"] = {"error": "No transcription result."}
+                job["done"].set()
+
+def start_stt_workers(preload_model):
+    for index in range(STT_WORKER_PROCESSES):
+        process, conn = start_stt_worker(index, preload_model)
+        threading.Thread(target=stt_dispatcher, args=(index, process, conn, preload_model), daemon=True).start()
+    print(f"[INFO] Started {STT_WORKER_PROCESSES} STT worker process(es).")
 	
 	
     
@@ -119,7 +438,12 @@ def load_settings():
     defaults = {
         "model": DEFAULT_OLLAMA_MODEL, "tts_lang": "en-us", "tts_voice": "af_heart", 
         "tts_speed": 1.0, "system_message": DEFAULT_SYSTEM_MESSAGE, "temperature": DEFAULT_TEMPERATURE,
-        "top_p": DEFAULT_TOP_P, "num_ctx": DEFAULT_NUM_CTX, "tts_enabled": "On"
+        "top_p": DEFAULT_TOP_P, "num_ctx": DEFAULT_NUM_CTX, "tts_enabled": "On", "whisper_model": WHISPER_MODEL,
+        "stt_profile": DEFAULT_STT_PROFILE, "stt_profiles": DEFAULT_STT_PROFILES, "barge_in": "On", "two_pass_stt": "Off",
+        "keep_alive": DEFAULT_KEEP_ALIVE,
+        "context_policy": DEFAULT_CONTEXT_POLICY, "context_budget": CONTEXT_BUDGET_FRACTION,
+        "image_turns": DEFAULT_IMAGE_TURNS, "token_flush_ms": TOKEN_FLUSH_MS,
+        "response_cache": "Off", "fast_model": "", "routing_rules": DEFAULT_ROUTING_RULES
     }
     if not os.path.exists(SETTINGS_FILE): return defaults
     try:
@@ -131,28 +455,342 @@ def load_settings():
         print(f"[ERROR] Could not read settings file, using defaults: {e}", file=sys.stderr)
         return defaults
 
-def get_ollama_models():
-    try:
-        resp = requests.get("http://localhost:11434/api/tags", timeout=3)
+# --- LLM Backends ---
+# All model calls go through llm_backend, so another local runtime can be benchmarked against Ollama.
+# A backend lists models, checks that one exists, preloads/unloads it, and chats with or without
+# streaming. Replies and stream chunks use Ollama's shape ({"message": {"content"}, "done", and the
+# prompt_eval_count/eval_count/..._duration stats}) whatever the backend.
+def http_client_options():
+    # Pool limits and timeouts for every backend client, so connections are set up once and reused
+    return {"timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            "limits": httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                   keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)}
+
+
+class OllamaBackend:
+    name = "ollama"
+
+    def __init__(self):
+        self.client = ollama.Client(**http_client_options())
+        self.async_client = None
+
+    def list_models(self):
+        try:
+            # Through the pooled HTTP client directly, since ollama.Client.list() can't take a timeout
+            resp = self.client._client.get("/api/tags", timeout=MODEL_LIST_TIMEOUT)
+            resp.raise_for_status()
+            return sorted([m["model"] for m in resp.json().get("models", [])])
+        except Exception:
+            try:
+                result = subprocess.run(["ollama", "list"], capture_output=True, text=True, timeout=5)
+                lines = result.stdout.strip().splitlines()
+                return sorted([line.split()[0] for line in lines[1:]]) if len(lines) > 1 else []
+            except Exception: return []
+
+    def check_model(self, model):
+        self.client.show(model)
+
+    def ping(self):
+        # Uses the pooled HTTP client of ollama.Client directly, since its API calls can't take a timeout
+        self.client._client.get("/api/version", timeout=HEALTH_CHECK_TIMEOUT).raise_for_status()
+
+    def describe_model(self, model):
+        # Through the pooled HTTP client with MODEL_LIST_TIMEOUT, like list_models, so a hung Ollama can't stall the registry
+        resp = self.client._client.post("/api/show", json={"model": model}, timeout=MODEL_LIST_TIMEOUT)
         resp.raise_for_status()
-        return sorted([m["name"] for m in resp.json().get("models", [])])
-    except Exception:
+        info = resp.json()
+        model_info = info.get("model_info") or {}
+        capabilities = list(info.get("capabilities") or []) # Reported by newer Ollama versions
+        details = info.get("details") or {}
+        return {"context_length": next((v for k, v in model_info.items() if k.endswith(".context_length")), None),
+                "vision": "vision" in capabilities or any(".vision." in k for k in model_info),
+                "capabilities": capabilities, "family": details.get("family"),
+                "parameter_size": details.get("parameter_size"), "quantization": details.get("quantization_level")}
+
+    def chat(self, model, messages, options, keep_alive):
+        return self.client.chat(model=model, messages=messages, stream=False, options=options, keep_alive=keep_alive)
+
+    async def stream_chat(self, model, messages, options, keep_alive):
+        if self.async_client is None: self.async_client = ollama.AsyncClient(**http_client_options()) # Created on the generation loop that uses it
+        async for chunk in await self.async_client.chat(model=model, messages=messages, stream=True, options=options, keep_alive=keep_alive):
+            yield chunk
+
+    def preload(self, model, num_ctx, keep_alive):
+        # An empty prompt only loads the model. num_ctx must match the chat requests or Ollama reloads it.
+        self.client.generate(model=model, prompt="", keep_alive=keep_alive, options={"num_ctx": num_ctx})
+
+    def unload(self, model):
+        self.client.generate(model=model, prompt="", keep_alive=0)
+
+
+class OpenAICompatibleBackend:
+    # llama.cpp's llama-server and similar runtimes. The server loads its model itself, so preload and
+    # unload do nothing, and num_ctx and keep_alive are set on the server rather than per request.
+    name = "openai"
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.client = httpx.Client(**http_client_options())
+        self.async_client = None
+        self.model_meta = {}
+
+    def list_models(self):
         try:
-            result = subprocess.run(["ollama", "list"], capture_output=True, text=True, timeout=5)
-            lines = result.stdout.strip().splitlines()
-            return sorted([line.split()[0] for line in lines[1:]]) if len(lines) > 1 else []
+            resp = self.client.get(f"{self.base_url}/models", timeout=MODEL_LIST_TIMEOUT)
+            resp.raise_for_status()
+            models = resp.json().get("data", [])
+            self.model_meta = {m["id"]: m.get("meta") or {} for m in models}
+            return sorted(self.model_meta)
         except Exception: return []
 
+    def check_model(self, model):
+        if model not in self.list_models(): raise RuntimeError(f"Model '{model}' is not served at {self.base_url}")
+
+    def ping(self):
+        self.client.get(f"{self.base_url}/models", timeout=HEALTH_CHECK_TIMEOUT).raise_for_status()
+
+    def describe_model(self, model):
+        # llama-server reports the training context size in "meta". Vision support isn't reported.
+        return {"context_length": self.model_meta.get(model, {}).get("n_ctx_train"), "vision": None}
+
+    def build_request(self, model, messages, options, stream):
+        body = {"model": model, "messages": [self.convert_message(m) for m in messages], "stream": stream,
+                "temperature": options.get("temperature"), "top_p": options.get("top_p")}
+        if options.get("num_predict"): body["max_tokens"] = options["num_predict"]
+        if stream: body["stream_options"] = {"include_usage": True}
+        return body
+
+    @staticmethod
+    def convert_message(msg):
+        if not msg.get("images"): return {"role": msg["role"], "content": msg.get("content", "")}
+        return {"role": msg["role"], "content": [{"type": "text", "text": msg.get("content", "")}] +
+                [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}"}} for img in msg["images"]]}
+
+    @staticmethod
+    def convert_stats(usage, timings):
+        # OpenAI usage counts, plus durations when the server reports llama.cpp-style timings
+        stats = {}
+        if usage: stats.update(prompt_eval_count=usage.get("prompt_tokens", 0), eval_count=usage.get("completion_tokens", 0))
+        if timings:
+            stats.update(prompt_eval_count=timings.get("prompt_n", stats.get("prompt_eval_count", 0)), eval_count=timings.get("predicted_n", stats.get("eval_count", 0)),
+                         prompt_eval_duration=int(timings.get("prompt_ms", 0) * 1e6), eval_duration=int(timings.get("predicted_ms", 0) * 1e6))
+        return stats
+
+    def chat(self, model, messages, options, keep_alive):
+        resp = self.client.post(f"{self.base_url}/chat/completions", json=self.build_request(model, messages, options, False))
+        resp.raise_for_status()
+        data = resp.json()
+        content = data["choices"][0]["message"].get("content") or ""
+        return {"message": {"role": "assistant", "content": content}, "done": True, **self.convert_stats(data.get("usage"), data.get("timings"))}
+
+    async def stream_chat(self, model, messages, options, keep_alive):
+        if self.async_client is None: self.async_client = httpx.AsyncClient(**http_client_options())
+        usage = timings = None
+        async with self.async_client.stream("POST", f"{self.base_url}/chat/completions", json=self.build_request(model, messages, options, True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"): continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]": break
+                data = json.loads(payload)
+                usage, timings = data.get("usage") or usage, data.get("timings") or timings
+                for choice in data.get("choices", []):
+                    content = (choice.get("delta") or {}).get("content")
+                    if content: yield {"message": {"role": "assistant", "content": content}, "done": False}
+        yield {"message": {"role": "assistant", "content": ""}, "done": True, **self.convert_stats(usage, timings)}
+
+    def preload(self, model, num_ctx, keep_alive): pass
+
+    def unload(self, model): pass
+
+
+llm_backend = OpenAICompatibleBackend(OPENAI_BASE_URL) if LLM_BACKEND == "openai" else OllamaBackend()
+
+
+# --- Backend Health ---
+# A stuck or crashed backend used to leave turns hanging until the HTTP timeout. A background thread now
+# pings it every HEALTH_CHECK_INTERVAL seconds, and pings and reply streams both feed a circuit breaker.
+# After BREAKER_FAILURE_THRESHOLD connection failures in a row, or one reply that doesn't start within
+# BACKEND_RESPONSE_TIMEOUT, the breaker opens and new turns fail at once with the reason. Once the
+# backend answers pings again (and at least BREAKER_OPEN_SECONDS have passed) it half-opens: the next
+# turn is let through, and closes the breaker if it succeeds or opens it again if it fails.
+class BackendUnavailable(Exception): pass
+
+backend_health = {"state": "closed", "failures": 0, "error": None, "opened_at": None, "last_check": None, "ping_ms": None, # state: closed, open, half_open
+                  "trial_in_flight": False, "trial_turn": None} # The one turn let through in the half_open state
+backend_health_lock = threading.RLock()
+
+def is_backend_down_error(error):
+    # Only transport failures say anything about the backend's health. A missing model or a bad request doesn't.
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError, BackendUnavailable))
+
+def set_backend_state(state, error=None):
+    # Called with backend_health_lock held
+    previous = backend_health["state"]
+    backend_health.update(state=state, error=error if state == "open" else None, trial_in_flight=False, trial_turn=None)
+    if state == "open": backend_health["opened_at"] = time.time()
+    if state == "closed": backend_health.update(failures=0, opened_at=None)
+    if state == previous: return
+    if state == "open": print(f"[HEALTH] {llm_backend.name} backend is unavailable, turning away new turns: {error}", file=sys.stderr)
+    elif state == "half_open": print(f"[HEALTH] {llm_backend.name} backend answers again, letting the next turn through.")
+    else: print(f"[HEALTH] {llm_backend.name} backend is healthy again.")
+    socketio.emit('backend_health', get_backend_health())
+
+def record_backend_success():
+    with backend_health_lock:
+        backend_health["failures"] = 0
+        if backend_health["state"] == "half_open": set_backend_state("closed")
+
+def record_backend_failure(error, trip=False):
+    with backend_health_lock:
+        backend_health["failures"] += 1
+        if trip or backend_health["state"] == "half_open" or backend_health["failures"] >= BREAKER_FAILURE_THRESHOLD:
+            set_backend_state("open", str(error) or type(error).__name__)
+
+def check_backend_available(turn_id):
+    # Returns True if this turn is the half_open trial. It must then call release_backend_trial when done.
+    with backend_health_lock:
+        state, error = backend_health["state"], backend_health["error"]
+        if state == "closed": return False
+        if state == "half_open" and not backend_health["trial_in_flight"]:
+            backend_health.update(trial_in_flight=True, trial_turn=turn_id)
+            return True
+    if state == "half_open": raise BackendUnavailable(f"Reconnecting to the {llm_backend.name} backend with another message. Please try again in a moment.")
+    raise BackendUnavailable(f"The {llm_backend.name} backend is not responding ({error}). Reconnecting, please try again in a moment.")
+
+def release_backend_trial(turn_id):
+    # A trial turn that never reached the backend (a cached reply, a stop, a bad request) frees the trial for the next turn
+    with backend_health_lock:
+        if backend_health["trial_turn"] == turn_id: backend_health.update(trial_in_flight=False, trial_turn=None)
+
+def is_backend_healthy():
+    with backend_health_lock: return backend_health["state"] == "closed"
+
+def health_monitor():
+    while True:
+        start_time = time.perf_counter()
+        try:
+            llm_backend.ping()
+            ping_ms = round((time.perf_counter() - start_time) * 1000)
+            with backend_health_lock:
+                backend_health.update(last_check=time.time(), ping_ms=ping_ms)
+                if backend_health["state"] == "open":
+                    if time.time() - backend_health["opened_at"] >= BREAKER_OPEN_SECONDS: set_backend_state("half_open")
+                else: backend_health["failures"] = 0
+        except Exception as e:
+            with backend_health_lock: backend_health.update(last_check=time.time(), ping_ms=None)
+            record_backend_failure(f"health check failed: {e}")
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+def start_health_monitor():
+    threading.Thread(target=health_monitor, daemon=True).start()
+
+def get_backend_health():
+    with backend_health_lock: return {"backend": llm_backend.name, **backend_health}
+
 # --- History Functions ---
+# The server owns the saved conversations. They are read from disk once and kept in memory, and each
+# turn is appended here, so the client only sends the new user message instead of the whole history.
+conversations_cache = None
+conversations_lock = threading.Lock()
+
 def load_conversations():
-    if not os.path.exists(CONVERSATIONS_FILE): return []
-    try:
-        with open(CONVERSATIONS_FILE, "r") as f: return json.load(f)
-    except (json.JSONDecodeError, IOError): return []
+    global conversations_cache
+    if conversations_cache is None:
+        conversations_cache = []
+        if os.path.exists(CONVERSATIONS_FILE):
+            try:
+                with open(CONVERSATIONS_FILE, "r") as f: conversations_cache = json.load(f)
+            except (json.JSONDecodeError, IOError): pass
+    return conversations_cache
 
 def save_conversations(conversations):
+    global conversations_cache
+    conversations_cache = conversations
     with open(CONVERSATIONS_FILE, "w") as f: json.dump(conversations, f, indent=2)
 
+def get_conversation_history(chat_id):
+    with conversations_lock:
+        chat = next((c for c in load_conversations() if c.get('id') == chat_id), None)
+        return list(chat["history"]) if chat else []
+
+def save_conversation_turn(chat_id, history, reply, settings, final_text=None, metrics=None):
+    # history ends with the user message of this turn. A two-pass turn is saved with the final transcript.
+    user_message = history[-1] if final_text is None else {**history[-1], "content": final_text}
+    assistant_message = {"role": "assistant", "content": reply, **({"metrics": metrics} if metrics else {})}
+    chat_history = history[:-1] + [user_message, assistant_message]
+    with conversations_lock:
+        conversations = load_conversations()
+        chat_index = next((i for i, c in enumerate(conversations) if c.get('id') == chat_id), -1)
+        if chat_index == -1:
+            first_user_message = next((m for m in chat_history if m["role"] == "user"), None)
+            title = (first_user_message.get("content") or "Image Query")[:40] if first_user_message else "Untitled Chat"
+            chat = {"id": chat_id, "title": title}
+        else:
+            chat = conversations.pop(chat_index)
+        chat.update({"timestamp": datetime.now(timezone.utc).isoformat(), "history": chat_history, "settings": settings or chat.get("settings", {})})
+        conversations.insert(0, chat)
+        save_conversations(conversations)
+
+def save_image_captions(chat_id, index, captions):
+    with conversations_lock:
+        chat = next((c for c in load_conversations() if c.get('id') == chat_id), None)
+        if chat is None or index >= len(chat["history"]) or len(chat["history"][index].get("images", [])) != len(captions): return
+        chat["history"][index]["image_captions"] = captions
+        save_conversations(load_conversations())
+
+
+# --- Image Store ---
+# Images are saved once under their SHA-256 and chat messages only carry their URL (/images/<hash>.jpg).
+# The browser shows them from that URL, and the server reads them back when it builds the Ollama prompt.
+# Older chats with inline data URLs are still accepted, and are converted at startup.
+IMAGE_URL_PREFIX = "/images/"
+IMAGE_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif", "image/bmp": "bmp"}
+image_data_cache = OrderedDict() # image URL -> base64 data
+image_data_lock = threading.Lock()
+
+def store_image(data, mimetype="image/jpeg"):
+    name = f"{hashlib.sha256(data).hexdigest()}.{IMAGE_EXTENSIONS.get(mimetype, 'jpg')}"
+    path = os.path.join(IMAGE_STORE_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f: f.write(data)
+        os.replace(temp_path, path)
+    return IMAGE_URL_PREFIX + name
+
+def store_data_url(data_url):
+    header, data = data_url.split(',', 1)
+    return store_image(base64.b64decode(data), header[len("data:"):].split(';')[0])
+
+def resolve_image(img):
+    # Returns the base64 data Ollama expects for an image URL (or a legacy data URL), or None if the file is gone
+    if img.startswith("data:"): return img.split(',', 1)[1]
+    with image_data_lock:
+        if img in image_data_cache:
+            image_data_cache.move_to_end(img)
+            return image_data_cache[img]
+    try:
+        with open(os.path.join(IMAGE_STORE_DIR, os.path.basename(img)), "rb") as f: data = base64.b64encode(f.read()).decode("utf-8")
+    except OSError as e:
+        print(f"[WARNING] Could not read image '{img}', leaving it out: {e}", file=sys.stderr)
+        return None
+    with image_data_lock:
+        image_data_cache[img] = data
+        if len(image_data_cache) > IMAGE_CACHE_SIZE: image_data_cache.popitem(last=False)
+    return data
+
+def migrate_inline_images():
+    conversations, converted = load_conversations(), 0
+    for chat in conversations:
+        for msg in chat.get("history", []):
+            for i, img in enumerate(msg.get("images", [])):
+                if img.startswith("data:"):
+                    msg["images"][i] = store_data_url(img); converted += 1
+    if converted:
+        save_conversations(conversations)
+        print(f"[INFO] Moved {converted} inline images from the chat history to '{IMAGE_STORE_DIR}'.")
+
 
 # --- Helper Functions ---
 def clean_text(text):
@@ -166,14 +804,88 @@ def clean_text(text):
         emoji_pattern = re.compile(u'(\ud83c[\udf00-\udfff]|\ud83d[\udc00-\ude4f\ude80-\udeff]|[\u2600-\u26FF\u2700-\u27BF])+', flags=re.UNICODE)
     return emoji_pattern.sub(r'', text).strip()
 
-def has_repeated_phrases(text: str) -> bool:
-    pattern = r"(.{10,})(\s*\1){2,}"
-    return bool(re.search(pattern, text))
+def has_repeated_phrases(text: str, min_phrase_chars=10, min_repeats=3) -> bool:
+    # Detects a phrase of 10+ characters repeated 3+ times in a row (a common Whisper hallucination), with any
+    # whitespace between the repeats. Case is ignored. A regex backreference search can take seconds on long
+    # garbled transcripts, so this runs in O(n log^2 n): whitespace is removed, then for each phrase length p only
+    # the positions that are multiples of p are checked, and matches are extended around them using rolling hashes.
+    # The phrase length is measured in the original text, from the start of one repeat to the start of the next.
+    if len(text) < min_phrase_chars * min_repeats: return False
+    text = text.lower()
+    positions = [i for i, ch in enumerate(text) if not ch.isspace()] + [len(text)]
+    s = "".join(text[i] for i in positions[:-1])
+    n = len(s)
+    mod, base = (1 << 61) - 1, 911382323
+    prefix, powers = [0] * (n + 1), [1] * (n + 1)
+    for i, ch in enumerate(s):
+        prefix[i + 1] = (prefix[i] * base + ord(ch)) % mod
+        powers[i + 1] = powers[i] * base % mod
+
+    def substring_hash(start, length):
+        return (prefix[start + length] - prefix[start] * powers[length]) % mod
+
+    def common_prefix(a, b, limit): # Length of the longest common prefix of s[a:] and s[b:]
+        lo, hi = 0, limit
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if substring_hash(a, mid) == substring_hash(b, mid): lo = mid
+            else: hi = mid - 1
+        return lo
+
+    def common_suffix(a, b, limit): # Length of the longest common suffix of s[:a] and s[:b]
+        lo, hi = 0, limit
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if substring_hash(a - mid, mid) == substring_hash(b - mid, mid): lo = mid
+            else: hi = mid - 1
+        return lo
+
+    # Any run of repeats with period p contains a multiple of p within its first p characters
+    for p in range(1, n // min_repeats + 1):
+        for anchor in range(0, n - p, p):
+            other = anchor + p
+            # A long enough run needs a full phrase match on at least one side of the anchor
+            forward_match = other + p <= n and substring_hash(anchor, p) == substring_hash(other, p)
+            if not forward_match and (anchor < p or substring_hash(anchor - p, p) != substring_hash(other - p, p)): continue
+            needed = (min_repeats - 1) * p
+            forward = common_prefix(anchor, other, min(n - other, needed))
+            backward = common_suffix(anchor, other, min(anchor, needed))
+            # Every start in this range begins min_repeats repeats. A phrase shorter than min_phrase_chars without
+            # whitespace only counts if the whitespace in it makes it long enough.
+            for start in range(anchor - backward, anchor + forward - needed + 1):
+                if positions[start + p] - positions[start] < min_phrase_chars: continue
+                # Compare the actual text to rule out a hash collision
+                if s[start:start + p] * min_repeats == s[start:start + min_repeats * p]: return True
+    return False
 	
 def contains_mixed_scripts(text: str) -> bool:
     scripts = {"latin": re.compile(r'[a-zA-Z]'), "cjk": re.compile(r'[\u4e00-\u9fff]'), "cyrillic": re.compile(r'[\u0400-\u04FF]')}
     return sum(1 for script in scripts.values() if script.search(text)) > 1
 
+def get_stt_language(tts_lang, whisper_model_name):
+    # Use the voice language so Whisper skips language detection. English-only models only support "en".
+    if whisper_model_name.endswith(".en"): return "en"
+    return (tts_lang or "").split("-")[0] or None
+
+def get_draft_whisper_model(tts_lang):
+    if get_stt_language(tts_lang, WHISPER_DRAFT_MODEL) == "en" and not WHISPER_DRAFT_MODEL.endswith(".en"):
+        return WHISPER_DRAFT_MODEL + ".en"
+    return WHISPER_DRAFT_MODEL
+
+def transcript_similarity(draft, final):
+    draft_words, final_words = re.findall(r"\w+", draft.lower()), re.findall(r"\w+", final.lower())
+    if not final_words: return 0.0
+    return difflib.SequenceMatcher(None, draft_words, final_words).ratio()
+
+def get_stt_options(settings, profile_name, language):
+    profiles = settings.get("stt_profiles") or DEFAULT_STT_PROFILES
+    profile = profiles.get(profile_name) or DEFAULT_STT_PROFILES.get(profile_name) or DEFAULT_STT_PROFILES[DEFAULT_STT_PROFILE]
+    options = {key: value for key, value in profile.items() if value is not None}
+    if isinstance(options.get("temperature"), list): options["temperature"] = tuple(options["temperature"])
+    options["language"] = language
+    options["fp16"] = False
+    return options
+
 def split_into_sentences(text):
     abbreviations = r'(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|vs|etc|i\.e|e\.g|Inc|Ltd|Corp|Co)'
     protected_text = re.sub(rf'({abbreviations})\.', r'\1<PERIOD>', text, flags=re.IGNORECASE)
@@ -190,18 +902,113 @@ def split_into_sentences(text):
 
 
 # --- Global Model List ---
-model_list = get_ollama_models()
-if not model_list:
-    print(f"[WARNING] No Ollama models found. Defaulting to: {DEFAULT_OLLAMA_MODEL}", file=sys.stderr)
-    model_list.append(DEFAULT_OLLAMA_MODEL)
+if not IS_STT_WORKER:
+    model_list = llm_backend.list_models()
+    if not model_list:
+        print(f"[WARNING] No models found ({llm_backend.name} backend). Defaulting to: {DEFAULT_OLLAMA_MODEL}", file=sys.stderr)
+        model_list.append(DEFAULT_OLLAMA_MODEL)
+
+    user_settings = load_settings()
+    OLLAMA_MODEL = user_settings.get("model", model_list[0])
+    if OLLAMA_MODEL not in model_list:
+        print(f"[WARNING] Saved model '{OLLAMA_MODEL}' not found. Defaulting to '{model_list[0]}'")
+        OLLAMA_MODEL = model_list[0]
+        user_settings["model"] = OLLAMA_MODEL
+        save_settings(user_settings)
+
+
+# --- Model Registry ---
+# model_list was read once at start-up, so models pulled later never appeared. A background thread now
+# refreshes it every MODEL_REFRESH_INTERVAL seconds (updating model_list in place) and adds metadata such
+# as context length and vision support. The UI polls /models, which only returns the cached registry.
+model_details = {} # model -> metadata from the backend
+model_registry_version = 0 # Increases whenever the list or the metadata changes
+model_registry_lock = threading.Lock()
+
+def refresh_model_registry():
+    global model_registry_version
+    names = llm_backend.list_models()
+    if not names: return # Keep the last known list while the backend is unreachable
+    details = {}
+    for name in names:
+        try: details[name] = model_details.get(name) or llm_backend.describe_model(name)
+        except Exception as e:
+            print(f"[WARNING] Could not read details of model '{name}': {e}", file=sys.stderr)
+            details[name] = {}
+    with model_registry_lock:
+        if names == model_list and details == model_details: return
+        added = sorted(set(names) - set(model_list))
+        model_list[:] = names
+        model_details.clear(); model_details.update(details)
+        model_registry_version += 1
+    if added: print(f"[INFO] New models found: {', '.join(added)}")
+
+def model_registry_refresher():
+    while True:
+        try: refresh_model_registry()
+        except Exception as e: print(f"[WARNING] Model list refresh failed: {e}", file=sys.stderr)
+        time.sleep(MODEL_REFRESH_INTERVAL)
+
+def start_model_registry():
+    threading.Thread(target=model_registry_refresher, daemon=True).start()
+
+def get_model_registry():
+    with model_registry_lock:
+        return {"version": model_registry_version, "models": [{"name": name, **model_details.get(name, {})} for name in model_list]}
+
+
+# --- Ollama Model Lifecycle ---
+# Keeps the selected model loaded in Ollama so voice turns don't pay the model load time. The model is
+# preloaded at start-up and whenever the model, context size or keep-alive setting changes, and the
+# previously selected model is unloaded to free memory. Load progress is pushed to the UI.
+model_status = {"model": None, "state": "idle", "error": None} # state: idle, loading, ready, error
+model_preload_target = {}
+model_preload_lock = threading.Lock()
+model_preload_event = threading.Event()
+
+def parse_keep_alive(value):
+    value = str(value if value is not None else DEFAULT_KEEP_ALIVE).strip()
+    return int(value) if value.lstrip("-").isdigit() else value
+
+def set_model_status(model, state, error=None):
+    model_status.update({"model": model, "state": state, "error": error})
+    socketio.emit('model_status', dict(model_status))
+
+def request_model_preload(model, num_ctx, keep_alive):
+    # Only the latest request is kept, so dragging a slider doesn't queue up several loads
+    with model_preload_lock:
+        model_preload_target.update({"model": model, "num_ctx": int(num_ctx), "keep_alive": parse_keep_alive(keep_alive)})
+        model_preload_event.set()
+
+def model_preloader():
+    loaded_model = None
+    while True:
+        model_preload_event.wait()
+        with model_preload_lock:
+            target = dict(model_preload_target)
+            model_preload_event.clear()
+        model = target["model"]
+        if loaded_model and loaded_model != model:
+            try:
+                llm_backend.unload(loaded_model)
+                print(f"[INFO] Unloaded Ollama model '{loaded_model}'.")
+            except Exception as e:
+                print(f"[WARNING] Could not unload Ollama model '{loaded_model}': {e}", file=sys.stderr)
+            loaded_model = None
+        set_model_status(model, "loading")
+        start_time = time.perf_counter()
+        try:
+            llm_backend.preload(model, target["num_ctx"], target["keep_alive"])
+            loaded_model = model
+            print(f"[INFO] Ollama model '{model}' loaded in {time.perf_counter() - start_time:.1f}s (keep_alive: {target['keep_alive']}).")
+            set_model_status(model, "ready")
+        except Exception as e:
+            print(f"[ERROR] Could not preload Ollama model '{model}': {e}", file=sys.stderr)
+            set_model_status(model, "error", str(e))
 
-user_settings = load_settings()
-OLLAMA_MODEL = user_settings.get("model", model_list[0])
-if OLLAMA_MODEL not in model_list:
-    print(f"[WARNING] Saved model '{OLLAMA_MODEL}' not found. Defaulting to '{model_list[0]}'")
-    OLLAMA_MODEL = model_list[0]
-    user_settings["model"] = OLLAMA_MODEL
-    save_settings(user_settings)
+def start_model_preloader(settings):
+    threading.Thread(target=model_preloader, daemon=True).start()
+    request_model_preload(OLLAMA_MODEL, settings.get("num_ctx", DEFAULT_NUM_CTX), settings.get("keep_alive", DEFAULT_KEEP_ALIVE))
 
 
 # --- HTML Template ---
@@ -381,6 +1188,17 @@ HTML_TEMPLATE = """
             border-radius: 0.25rem;
         }
 
+        .model-status {
+            font-size: 0.8rem;
+            color: var(--slate-400);
+            margin-top: 0.4rem;
+            min-height: 1rem;
+        }
+
+        .model-status.error {
+            color: var(--red-500);
+        }
+
         .slider-container {
             margin-top: 1rem;
             padding-bottom: 0.5rem;
@@ -424,6 +1242,20 @@ HTML_TEMPLATE = """
             gap: 0.5rem;
         }
 
+        .prefill-status {
+            margin-right: auto;
+            font-size: 0.8rem;
+            color: var(--slate-400);
+        }
+
+        .prefill-status.ready {
+            color: var(--indigo-600);
+        }
+
+        .prefill-status.warning {
+            color: #b45309;
+        }
+
         .header-btn {
             background: none;
             border: 1px solid var(--slate-300);
@@ -816,6 +1648,15 @@ HTML_TEMPLATE = """
                 <select id="model-selector" class="sidebar-select">
                     {% for model in model_list %}<option value="{{ model }}" {% if model == current_model %}selected{% endif %}>{{ model }}</option>{% endfor %}
                 </select>
+                <div id="model-status" class="model-status"></div>
+                <div id="backend-health" class="model-status error hidden"></div>
+            </div>
+            <div class="sidebar-section">
+                <label for="fast-model-selector">Fast Model for Short Replies</label>
+                <select id="fast-model-selector" class="sidebar-select">
+                    <option value="">Off</option>
+                    {% for model in model_list %}<option value="{{ model }}">{{ model }}</option>{% endfor %}
+                </select>
             </div>
             <div class="sidebar-section">
                 <div class="collapsible-header" id="webcam-toggle"><span>Webcam Photo</span><span class="chevron">▼</span></div>
@@ -832,14 +1673,22 @@ HTML_TEMPLATE = """
                 <div class="collapsible-header" id="voice-settings-toggle"><span>Voice Settings</span><span class="chevron">▼</span></div>
                 <div class="collapsible-content" id="voice-settings-content">
                     <div class="sidebar-section" style="margin-top: 1rem;"><label for="tts-enabled-selector">Voice Output</label><select id="tts-enabled-selector" class="sidebar-select"><option value="On">On</option><option value="Off">Off</option></select></div>
+                    <div class="sidebar-section"><label for="barge-in-selector">Interrupt by Speaking</label><select id="barge-in-selector" class="sidebar-select"><option value="On">On</option><option value="Off">Off</option></select></div>
                     <div class="sidebar-section"><label for="language-selector">Language</label><select id="language-selector" class="sidebar-select"></select></div>
                     <div class="sidebar-section"><label for="voice-selector">Voice</label><select id="voice-selector" class="sidebar-select"></select></div>
+                    <div class="sidebar-section"><label for="stt-profile-selector">Speech Recognition Speed</label><select id="stt-profile-selector" class="sidebar-select">{% for profile in saved_settings.stt_profiles %}<option value="{{ profile }}">{{ profile | capitalize }}</option>{% endfor %}</select></div>
+                    <div class="sidebar-section"><label for="two-pass-selector">Two-Pass Speech Recognition</label><select id="two-pass-selector" class="sidebar-select"><option value="Off">Off</option><option value="On">On</option></select></div>
+                    <div class="sidebar-section"><label for="whisper-model-selector">Speech Recognition Model</label><select id="whisper-model-selector" class="sidebar-select">{% for size in whisper_model_sizes %}<option value="{{ size }}">{{ size }}</option>{% endfor %}</select></div>
                     <div class="slider-container"><div class="slider-label-container"><label for="speed-slider">Speech Speed</label><span id="speed-value" class="value-display">1.0x</span></div><input type="range" id="speed-slider" min="0.5" max="1.5" step="0.1"></div>
                 </div>
             </div>
             <div class="sidebar-section">
                 <div class="collapsible-header" id="llm-settings-toggle"><span>Model Parameters</span><span class="chevron">▼</span></div>
                 <div class="collapsible-content" id="llm-settings-content">
+                    <div class="sidebar-section" style="margin-top: 1rem;"><label for="keep-alive-selector">Keep Model Loaded</label><select id="keep-alive-selector" class="sidebar-select"><option value="5m">5 minutes</option><option value="30m">30 minutes</option><option value="2h">2 hours</option><option value="-1">Always</option></select></div>
+                    <div class="sidebar-section"><label for="context-policy-selector">When the Chat Is Too Long</label><select id="context-policy-selector" class="sidebar-select"><option value="sliding_window">Drop the oldest messages</option><option value="pin_first">Keep the first exchange</option><option value="summary">Summarize older messages</option></select></div>
+                    <div class="sidebar-section"><label for="response-cache-selector">Reuse Answers to Repeated Questions</label><select id="response-cache-selector" class="sidebar-select"><option value="Off">Off</option><option value="On">On (when temperature is 0)</option></select></div>
+                    <div class="sidebar-section"><label for="image-turns-selector">Send Full Images For</label><select id="image-turns-selector" class="sidebar-select"><option value="1">Last turn</option><option value="2">Last 2 turns</option><option value="4">Last 4 turns</option><option value="all">All turns</option></select></div>
                     <div class="slider-container"><div class="slider-label-container"><label for="num-ctx-slider">Context Size (Tokens)</label><span id="num-ctx-value" class="value-display">16000</span></div><input type="range" id="num-ctx-slider" min="0" max="128000" step="2000"></div>
                     <div class="slider-container"><div class="slider-label-container"><label for="temperature-slider">Temperature</label><span id="temperature-value" class="value-display">1.0</span></div><input type="range" id="temperature-slider" min="0" max="2" step="0.05"></div>
                     <div class="slider-container"><div class="slider-label-container"><label for="top-p-slider">Top P</label><span id="top-p-value" class="value-display">0.95</span></div><input type="range" id="top-p-slider" min="0" max="1" step="0.01"></div>
@@ -855,6 +1704,8 @@ HTML_TEMPLATE = """
         <div class="main-content">
             <main class="chat-view" id="chat-view">
                 <header class="chat-header">
+                    <span id="prefill-status" class="prefill-status hidden"></span>
+                    <span id="cache-warning" class="prefill-status warning hidden">Settings changed: the next reply will re-read the whole conversation</span>
                     <div class="header-controls">
                         <button class="header-btn" id="new-chat-btn">New Chat</button>
                         <button class="header-btn" id="history-btn">History</button>
@@ -893,6 +1744,10 @@ HTML_TEMPLATE = """
         modelSelector: document.getElementById('model-selector'), attachmentBtn: document.getElementById('attachment-btn'), fileInput: document.getElementById('file-input'), previewContainer: document.getElementById('image-preview-container'),
         stopAudioBtn: document.getElementById('stop-audio-btn'), welcomeScreen: document.getElementById('welcome-screen'), newChatBtn: document.getElementById('new-chat-btn'), chatView: document.getElementById('chat-view'),
         languageSelector: document.getElementById('language-selector'), voiceSelector: document.getElementById('voice-selector'), speedSlider: document.getElementById('speed-slider'), ttsEnabledSelector: document.getElementById('tts-enabled-selector'),
+        whisperModelSelector: document.getElementById('whisper-model-selector'), bargeInSelector: document.getElementById('barge-in-selector'),
+        twoPassSelector: document.getElementById('two-pass-selector'), keepAliveSelector: document.getElementById('keep-alive-selector'),
+        modelStatus: document.getElementById('model-status'), backendHealth: document.getElementById('backend-health'), fastModelSelector: document.getElementById('fast-model-selector'), contextPolicySelector: document.getElementById('context-policy-selector'),
+        imageTurnsSelector: document.getElementById('image-turns-selector'), responseCacheSelector: document.getElementById('response-cache-selector'), prefillStatus: document.getElementById('prefill-status'), cacheWarning: document.getElementById('cache-warning'), sttProfileSelector: document.getElementById('stt-profile-selector'),
         systemMessageInput: document.getElementById('system-message-input'), historyBtn: document.getElementById('history-btn'), historyPanel: document.getElementById('history-panel'), closeHistoryBtn: document.getElementById('close-history-btn'), historyList: document.getElementById('history-list'),
         dropzoneOverlay: document.getElementById('dropzone-overlay'),
         webcamToggle: document.getElementById('webcam-toggle'), webcamContent: document.getElementById('webcam-content'), webcamFeed: document.getElementById('webcam-feed'), webcamCanvas: document.getElementById('webcam-canvas'),
@@ -913,6 +1768,9 @@ HTML_TEMPLATE = """
     };
     const SILENCE_THRESHOLD = 0.01;
     const SILENCE_TIMEOUT = 1500;
+    const MODEL_POLL_INTERVAL = 30000; // How often the model list is checked for newly pulled models
+    const BARGE_IN_THRESHOLD = 0.05; // Higher than SILENCE_THRESHOLD because some speaker output reaches the mic
+    const BARGE_IN_MIN_SPEECH = 300; // ms of continuous speech needed to interrupt the assistant
     let isRecording = false;
     let mediaRecorder;
     let audioStream;
@@ -932,6 +1790,14 @@ HTML_TEMPLATE = """
     let isAudioPlaying = false;
     let isPlaybackStopped = false;
     let currentAiMessageElement = null;
+    let currentTurnId = 0; // Events from an older (interrupted) turn are ignored
+    let isVoiceTurn = false; // The current turn was spoken. Only spoken turns can be interrupted by voice.
+    let pendingDraft = null; // Two-pass STT turn waiting for the final transcript
+    let lastPrefillSignature = null;
+    let scrollPending = false;
+    let lastChatPayload = null; // Resent with the full history if the server's copy of the chat is out of sync
+    let prefillStatusTimer = null;
+    let bargeInStream = null, bargeInContext = null, bargeInInterval = null;
 
     // --- Core Functions ---
     document.addEventListener('DOMContentLoaded', async () => {
@@ -939,6 +1805,10 @@ HTML_TEMPLATE = """
         applySettingsToUI(savedSettings);
         setupEventListeners();
         setupSocketListeners();
+        fetch('/model_status').then(res => res.json()).then(updateModelStatus).catch(err => console.error("Could not load model status:", err));
+        fetch('/health').then(res => res.json()).then(updateBackendHealth).catch(err => console.error("Could not load backend health:", err));
+        refreshModelList();
+        setInterval(refreshModelList, MODEL_POLL_INTERVAL);
         try {
             const res = await fetch("/conversations");
             if (!res.ok) throw new Error("Failed to load histories");
@@ -948,7 +1818,7 @@ HTML_TEMPLATE = """
 
     function setupSocketListeners() {
         socket.on('llm_token', (data) => {
-            if (isPlaybackStopped) return;
+            if (isPlaybackStopped || data.turn_id !== currentTurnId) return;
             const token = data.token;
             
             if (!currentAiMessageElement) {
@@ -959,24 +1829,91 @@ HTML_TEMPLATE = """
                 currentAiMessageElement = addMessage({ role: 'assistant', content: '' });
             }
             
-            currentAiMessageElement.textContent += token;
-            ui.messageContainer.scrollTop = ui.messageContainer.scrollHeight;
+            currentAiMessageElement.append(token);
+            // Scroll once per frame however many batches arrive
+            if (!scrollPending) {
+                scrollPending = true;
+                requestAnimationFrame(() => { scrollPending = false; ui.messageContainer.scrollTop = ui.messageContainer.scrollHeight; });
+            }
         });
         socket.on('tts_audio_chunk', (data) => {
-            if (isPlaybackStopped) return;
+            if (isPlaybackStopped || data.turn_id !== currentTurnId) return;
             if (ui.ttsEnabledSelector.value === 'On' && data.audioData) {
                 audioQueue.push(data.audioData);
                 playNextInQueue();
             }
         });
         socket.on('chat_end', async (data) => {
+            if (data.turn_id !== currentTurnId) return;
             console.log("Chat stream finished.");
-            conversationHistory.push({ role: 'assistant', content: data.final_message });
-            await saveOrUpdateCurrentChat();
+            ui.cacheWarning.classList.add('hidden');
+            conversationHistory.push({ role: 'assistant', content: data.final_message, ...(data.metrics && { metrics: data.metrics }) });
+            if (data.metrics) console.log("Turn metrics:", data.metrics);
+            recordSavedChat(data.chat_id);
             currentAiMessageElement = null;
-            if (audioQueue.length === 0 && !isAudioPlaying) onAiSpeechEnd();
+            // After a barge-in the user is already recording the next message
+            if (audioQueue.length === 0 && !isAudioPlaying && !isRecording) onAiSpeechEnd();
+        });
+        socket.on('draft_result', onDraftResult);
+        socket.on('model_status', updateModelStatus);
+        socket.on('backend_health', updateBackendHealth);
+        socket.on('prefill_status', updatePrefillStatus);
+        socket.on('image_captions', storeImageCaptions);
+        socket.on('queue_status', (data) => {
+            const thinkingIndicator = ui.messageContainer.querySelector('.thinking');
+            if (data.turn_id !== currentTurnId || !thinkingIndicator) return;
+            thinkingIndicator.textContent = data.position === 1 ? `Waiting for the model (next in line, about ${data.estimated_wait}s)...`
+                : `Waiting for the model (${data.position} in line, about ${data.estimated_wait}s)...`;
         });
-        socket.on('error', (data) => handleError(data.error));
+        socket.on('history_mismatch', (data) => {
+            if (data.turn_id !== currentTurnId || !lastChatPayload) return;
+            socket.emit('chat_message', { ...lastChatPayload, history: conversationHistory.slice(0, -1) });
+        });
+        socket.on('error', (data) => { if (data.turn_id === undefined || data.turn_id === currentTurnId) handleError(data.error); });
+    }
+
+    // The server saves captions of aged-out images with their message. This keeps the local copy the same.
+    function storeImageCaptions(data) {
+        const msg = conversationHistory[data.index];
+        if (data.chat_id !== currentChatId || !msg?.images || msg.images.length !== data.captions.length) return;
+        msg.image_captions = data.captions;
+    }
+
+    // Keeps the model selectors in step with the models installed on the server
+    let modelRegistryVersion = null;
+    async function refreshModelList() {
+        try {
+            const res = await fetch('/models');
+            const registry = await res.json();
+            if (registry.version === modelRegistryVersion) return;
+            modelRegistryVersion = registry.version;
+            const names = registry.models.map(m => m.name);
+            [ui.modelSelector, ui.fastModelSelector].forEach(select => {
+                const current = select.value;
+                select.innerHTML = select === ui.fastModelSelector ? '<option value="">Off</option>' : '';
+                registry.models.forEach(m => {
+                    const option = new Option(m.name, m.name);
+                    option.title = [m.parameter_size, m.vision ? 'vision' : null, m.context_length ? `${m.context_length} token context` : null].filter(Boolean).join(', ');
+                    select.add(option);
+                });
+                if (current && !names.includes(current)) select.add(new Option(`${current} (not found)`, current));
+                select.value = current;
+            });
+        } catch (err) { console.warn("Could not refresh the model list:", err); }
+    }
+
+    function updateModelStatus(status) {
+        const labels = { loading: `Loading ${status.model}...`, ready: `${status.model} is loaded`, error: `Could not load ${status.model}` };
+        ui.modelStatus.textContent = labels[status.state] || '';
+        ui.modelStatus.classList.toggle('error', status.state === 'error');
+        if (status.error) ui.modelStatus.title = status.error; else ui.modelStatus.removeAttribute('title');
+    }
+
+    function updateBackendHealth(health) {
+        const labels = { open: `${health.backend} is not responding. Reconnecting...`, half_open: `${health.backend} is back. Retrying with the next message...` };
+        ui.backendHealth.textContent = labels[health.state] || '';
+        ui.backendHealth.classList.toggle('hidden', !labels[health.state]);
+        if (health.error) ui.backendHealth.title = health.error; else ui.backendHealth.removeAttribute('title');
     }
 
     function playNextInQueue() {
@@ -987,25 +1924,130 @@ HTML_TEMPLATE = """
         const audioBase64 = audioQueue.shift();
         ui.audioPlayer.src = `data:audio/wav;base64,${audioBase64}`;
         ui.audioPlayer.play().catch(e => { console.error("Audio playback error:", e); isAudioPlaying = false; });
+        startBargeInMonitor();
+    }
+
+    // --- Barge-in: listen for the user's voice while the assistant is speaking ---
+    async function startBargeInMonitor() {
+        if (bargeInStream || bargeInInterval || ui.bargeInSelector.value !== 'On' || !isVoiceTurn) return;
+        bargeInInterval = -1; // Reserve the monitor while the microphone permission resolves
+        try {
+            // Echo cancellation keeps the assistant's own voice from triggering an interruption
+            const stream = await navigator.mediaDevices.getUserMedia({ audio: { echoCancellation: true, noiseSuppression: true, autoGainControl: true } });
+            if (!isAudioPlaying || bargeInInterval !== -1) { stream.getTracks().forEach(track => track.stop()); return; }
+            bargeInStream = stream;
+            bargeInContext = new (window.AudioContext || window.webkitAudioContext)();
+            const monitor = bargeInContext.createAnalyser();
+            monitor.fftSize = 2048;
+            bargeInContext.createMediaStreamSource(stream).connect(monitor);
+            const dataArray = new Uint8Array(monitor.frequencyBinCount);
+            let speechStart = null;
+            bargeInInterval = setInterval(() => {
+                monitor.getByteTimeDomainData(dataArray);
+                let sum = 0;
+                for (let i = 0; i < dataArray.length; i++) {
+                    const value = (dataArray[i] - 128) / 128;
+                    sum += value * value;
+                }
+                const rms = Math.sqrt(sum / dataArray.length);
+                if (rms > BARGE_IN_THRESHOLD) {
+                    speechStart = speechStart || Date.now();
+                    if (Date.now() - speechStart >= BARGE_IN_MIN_SPEECH) interruptAssistant();
+                } else {
+                    speechStart = null;
+                }
+            }, 50);
+        } catch (err) {
+            console.error("Barge-in monitor error:", err);
+            bargeInInterval = null;
+        }
+    }
+
+    function stopBargeInMonitor({ keepStream = false } = {}) {
+        if (bargeInInterval && bargeInInterval !== -1) clearInterval(bargeInInterval);
+        bargeInInterval = null;
+        if (bargeInContext) { bargeInContext.close(); bargeInContext = null; }
+        if (bargeInStream && !keepStream) bargeInStream.getTracks().forEach(track => track.stop());
+        bargeInStream = null;
+    }
+
+    function interruptAssistant() {
+        console.log("User started speaking - interrupting the assistant");
+        // Hand the open microphone stream to the recorder so no speech is lost while it restarts
+        const stream = bargeInStream;
+        stopBargeInMonitor({ keepStream: true });
+        isPlaybackStopped = true;
+        socket.emit('stop_generation');
+        ui.audioPlayer.pause();
+        ui.audioPlayer.currentTime = 0;
+        audioQueue = [];
+        isAudioPlaying = false;
+        ui.micBtn.classList.remove('hidden');
+        ui.stopAudioBtn.classList.add('hidden');
+        ui.micBtn.classList.add('listening');
+        startRecording(stream);
     }
     
-    function sendTextToServer() {
+    function sendTextToServer({ speculative = false } = {}) {
         isPlaybackStopped = false;
         setControlsEnabled(false);
         addMessage({ role: 'thinking', content: 'Processing...' });
-        const payload = {
-            history: conversationHistory, model: ui.modelSelector.value, tts_voice: ui.voiceSelector.value, tts_speed: ui.speedSlider.value,
+        currentTurnId++;
+        isVoiceTurn = ui.micBtn.classList.contains('listening'); // A typed turn never opens the microphone
+        // Only the new message is sent. The server holds the rest of the conversation.
+        lastChatPayload = {
+            turn_id: currentTurnId, speculative: speculative, ...buildChatPayload(),
+            message: conversationHistory[conversationHistory.length - 1], history_length: conversationHistory.length - 1,
+            settings: getCurrentUISettings()
+        };
+        socket.emit('chat_message', lastChatPayload);
+    }
+
+    function buildChatPayload() {
+        return {
+            model: ui.modelSelector.value, fast_model: ui.fastModelSelector.value, tts_voice: ui.voiceSelector.value, tts_speed: ui.speedSlider.value,
             tts_lang: ui.languageSelector.value, system_message: ui.systemMessageInput.value, tts_enabled: ui.ttsEnabledSelector.value,
+            chat_id: currentChatId, context_policy: ui.contextPolicySelector.value, image_turns: ui.imageTurnsSelector.value,
             llm_options: {
                 temperature: ui.temperatureSlider.value, top_p: ui.topPSlider.value,
                 num_ctx: ui.numCtxSlider.value
             }
         };
-        socket.emit('chat_message', payload);
+    }
+
+    // Ask the server to load the current conversation into Ollama's prompt cache before the next turn
+    function requestPrefill(reason = 'input') {
+        const signature = JSON.stringify([currentChatId, conversationHistory.length, ui.modelSelector.value, ui.systemMessageInput.value, ui.numCtxSlider.value]);
+        if (signature === lastPrefillSignature) return;
+        lastPrefillSignature = signature;
+        socket.emit('prefill', { reason: reason, history_length: conversationHistory.length, ...buildChatPayload() });
+    }
+
+    // Shows whether a conversation opened from History has been loaded into the model's cache
+    function updatePrefillStatus(data) {
+        if (data.reason !== 'load' || data.chat_id !== currentChatId) return;
+        clearTimeout(prefillStatusTimer);
+        const el = ui.prefillStatus;
+        el.classList.remove('hidden', 'ready');
+        if (data.state === 'running') {
+            el.textContent = 'Preparing conversation...';
+        } else if (data.state === 'done' || data.state === 'cached') {
+            el.textContent = 'Ready';
+            el.classList.add('ready');
+            prefillStatusTimer = setTimeout(() => el.classList.add('hidden'), 3000);
+        } else {
+            el.classList.add('hidden');
+        }
     }
     
+    // These settings change the start of the prompt, so Ollama can't reuse its cached copy of the conversation
+    function warnPromptCacheReset() {
+        if (conversationHistory.length > 0) ui.cacheWarning.classList.remove('hidden');
+    }
+
     function onAiSpeechEnd() {
         isAudioPlaying = false;
+        stopBargeInMonitor();
         ui.micBtn.classList.remove('hidden');
         ui.stopAudioBtn.classList.add('hidden');
         setControlsEnabled(true);
@@ -1038,17 +2080,19 @@ HTML_TEMPLATE = """
         ui.stopAudioBtn.addEventListener('click', stopAudioPlayback);
         ui.attachmentBtn.addEventListener('click', () => ui.fileInput.click());
         ui.fileInput.addEventListener('change', handleFileSelect);
+        ui.messageInput.addEventListener('focus', () => requestPrefill('input'));
         ui.messageInput.addEventListener('keydown', e => { if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); submitUserMessage(); } });
         ui.newChatBtn.addEventListener('click', startNewChat);
         ui.historyBtn.addEventListener('click', () => { renderSavedChatsList(); ui.historyPanel.classList.add('open'); });
         ui.closeHistoryBtn.addEventListener('click', () => ui.historyPanel.classList.remove('open'));
         
         ui.languageSelector.addEventListener('input', () => { updateVoiceOptions(); saveAllSettings(); });
-        [ui.voiceSelector, ui.ttsEnabledSelector, ui.modelSelector, ui.systemMessageInput].forEach(el => el.addEventListener('input', saveAllSettings));
+        [ui.voiceSelector, ui.ttsEnabledSelector, ui.bargeInSelector, ui.twoPassSelector, ui.keepAliveSelector, ui.contextPolicySelector, ui.imageTurnsSelector, ui.responseCacheSelector, ui.fastModelSelector, ui.whisperModelSelector, ui.sttProfileSelector, ui.modelSelector, ui.systemMessageInput].forEach(el => el.addEventListener('input', saveAllSettings));
         const setupSlider = (slider, display, format) => slider.addEventListener('input', () => { display.textContent = format(slider.value); saveAllSettings(); });
         setupSlider(ui.speedSlider, document.getElementById('speed-value'), v => `${parseFloat(v).toFixed(1)}x`);
         setupSlider(ui.numCtxSlider, ui.numCtxValue, v => v); setupSlider(ui.temperatureSlider, ui.temperatureValue, v => parseFloat(v).toFixed(2));
         setupSlider(ui.topPSlider, ui.topPValue, v => parseFloat(v).toFixed(2));
+        [ui.modelSelector, ui.numCtxSlider, ui.systemMessageInput, ui.contextPolicySelector, ui.imageTurnsSelector].forEach(el => el.addEventListener('input', warnPromptCacheReset));
 
         ui.audioPlayer.addEventListener('ended', () => { isAudioPlaying = false; if (audioQueue.length > 0) playNextInQueue(); else onAiSpeechEnd(); });
         
@@ -1088,14 +2132,15 @@ HTML_TEMPLATE = """
         else stopRecording(true);
     }
 	
-    async function startRecording() {
+    async function startRecording(existingStream = null) {
         if (isRecording) return;
+        requestPrefill();
         
         setControlsEnabled(false, { keepMicActive: true });
         ui.chatView.classList.add('mic-active-shadow');
         
         try {
-            audioStream = await navigator.mediaDevices.getUserMedia({ audio: true });
+            audioStream = existingStream || await navigator.mediaDevices.getUserMedia({ audio: true });
             
             // Set up audio context for silence detection
             audioContext = new (window.AudioContext || window.webkitAudioContext)();
@@ -1250,57 +2295,126 @@ HTML_TEMPLATE = """
             return;
         }
         
-        // Send to transcription
+        if (ui.twoPassSelector.value === 'On') {
+            await transcribeTwoPass(audioBlob);
+            return;
+        }
+        try {
+            submitTranscript(await requestTranscription(audioBlob));
+        } catch (error) {
+            console.error('Transcription error:', error);
+            handleError(error.message || 'Transcription failed');
+        }
+    }
+
+    async function requestTranscription(audioBlob, pass = 'final') {
         const formData = new FormData();
         formData.append('audio_data', audioBlob, 'recording.wav');
-        
+        formData.append('whisper_model', ui.whisperModelSelector.value);
+        formData.append('stt_profile', ui.sttProfileSelector.value);
+        formData.append('tts_lang', ui.languageSelector.value);
+        formData.append('pass', pass);
+        const res = await fetch('/transcribe', { method: 'POST', body: formData });
+        const data = await res.json();
+        if (!res.ok) {
+            throw new Error(data.error || 'Transcription failed');
+        }
+        return data.transcribedText || '';
+    }
+
+    function restartListeningOrEnableControls() {
+        if (ui.micBtn.classList.contains('listening')) {
+            startRecording();
+        } else {
+            setControlsEnabled(true);
+        }
+    }
+
+    function createUserMessage(text) {
+        isPlaybackStopped = false;
+        const userMessage = {
+            role: 'user',
+            content: text,
+            ...(imageBase64Array.length > 0 && { images: [...imageBase64Array] })
+        };
+        const element = addMessage(userMessage);
+        conversationHistory.push(userMessage);
+        // Clear images
+        imageBase64Array = [];
+        updatePreviews();
+        return { userMessage, element };
+    }
+
+    function submitTranscript(transcribedText) {
+        // If no text and no images, restart recording if still listening
+        if (!transcribedText && imageBase64Array.length === 0) {
+            console.log("No text transcribed, restarting recording");
+            restartListeningOrEnableControls();
+            return;
+        }
+        createUserMessage(transcribedText);
+        sendTextToServer();
+    }
+
+    // --- Two-pass STT ---
+    // A small Whisper model returns a draft transcript first, and the reply starts generating from it
+    // straight away. The server holds the reply back until the full model's transcript arrives. If the two
+    // transcripts match closely the reply is released, otherwise it is discarded and the turn restarts.
+    async function transcribeTwoPass(audioBlob) {
+        let finalDone = false;
+        pendingDraft = null; // A draft left over from a failed turn must not take this turn's transcript
+        const finalPromise = requestTranscription(audioBlob, 'final');
+        requestTranscription(audioBlob, 'draft').then(draftText => {
+            if (finalDone || !draftText) return;
+            console.log("Draft transcript:", draftText);
+            const { userMessage, element } = createUserMessage(draftText);
+            sendTextToServer({ speculative: true });
+            pendingDraft = { turnId: currentTurnId, userMessage, element };
+        }).catch(err => console.warn("Draft transcription failed:", err));
+
+        let finalText;
         try {
-            const res = await fetch('/transcribe', { method: 'POST', body: formData });
-            const data = await res.json();
-            
-            if (!res.ok) {
-                throw new Error(data.error || 'Transcription failed');
-            }
-            
-            const transcribedText = data.transcribedText || '';
-            
-            // If no text and no images, restart recording if still listening
-            if (!transcribedText && imageBase64Array.length === 0) {
-                console.log("No text transcribed, restarting recording");
-                if (ui.micBtn.classList.contains('listening')) {
-                    startRecording();
-                } else {
-                    setControlsEnabled(true);
-                }
-                return;
-            }
-            
-            isPlaybackStopped = false;
-            // Create user message
-            const userMessage = {
-                role: 'user',
-                content: transcribedText,
-                ...(imageBase64Array.length > 0 && { images: [...imageBase64Array] })
-            };
-            
-            addMessage(userMessage);
-            conversationHistory.push(userMessage);
-            
-            // Clear images
-            imageBase64Array = [];
-            updatePreviews();
-            
-            // Send to server
-            sendTextToServer();
-            
+            finalText = await finalPromise;
         } catch (error) {
             console.error('Transcription error:', error);
+            if (pendingDraft) socket.emit('confirm_draft', { turn_id: pendingDraft.turnId, text: '' });
+            pendingDraft = null;
             handleError(error.message || 'Transcription failed');
+            return;
         }
+        finalDone = true;
+        if (!pendingDraft) {
+            submitTranscript(finalText);
+            return;
+        }
+        // The final transcript replaces the draft in the conversation either way
+        pendingDraft.finalText = finalText;
+        pendingDraft.userMessage.content = finalText;
+        const bubble = pendingDraft.element.querySelector('.text-bubble');
+        if (bubble) bubble.textContent = finalText;
+        socket.emit('confirm_draft', { turn_id: pendingDraft.turnId, text: finalText });
+    }
+
+    function onDraftResult(data) {
+        if (!pendingDraft || data.turn_id !== pendingDraft.turnId) return;
+        const draft = pendingDraft;
+        pendingDraft = null;
+        if (data.accepted) return; // The held-back reply is now streamed as usual
+        console.log("Draft transcript rejected, restarting the turn with the final transcript");
+        const thinkingIndicator = ui.messageContainer.querySelector('.thinking');
+        if (thinkingIndicator) thinkingIndicator.remove();
+        if (!draft.finalText && !draft.userMessage.images) {
+            conversationHistory.pop();
+            draft.element.remove();
+            restartListeningOrEnableControls();
+            return;
+        }
+        sendTextToServer();
     }
 
     function handleError(errorMessage, indicator) {
         console.error('Error:', errorMessage);
+        pendingDraft = null; // The server has dropped the turn, so there is no draft left to confirm
         if (indicator || currentAiMessageElement) { (indicator || currentAiMessageElement).remove(); currentAiMessageElement = null; }
         addMessage({ role: 'assistant', content: errorMessage || 'An unknown error occurred.', isError: true });
         if (conversationHistory.length > 0 && conversationHistory.slice(-1)[0].role === 'user') conversationHistory.pop();
@@ -1341,6 +2455,15 @@ HTML_TEMPLATE = """
         const updateSlider = (slider, valueDisplay, value, formatFn) => { slider.value = value; valueDisplay.textContent = formatFn(value); };
         ui.systemMessageInput.value = settings.system_message; ui.modelSelector.value = settings.model; ui.ttsEnabledSelector.value = settings.tts_enabled;
         ui.languageSelector.value = settings.tts_lang; updateVoiceOptions(); ui.voiceSelector.value = settings.tts_voice;
+        if (settings.whisper_model) ui.whisperModelSelector.value = settings.whisper_model;
+        if (settings.stt_profile) ui.sttProfileSelector.value = settings.stt_profile;
+        if (settings.barge_in) ui.bargeInSelector.value = settings.barge_in;
+        if (settings.two_pass_stt) ui.twoPassSelector.value = settings.two_pass_stt;
+        if (settings.keep_alive) ui.keepAliveSelector.value = settings.keep_alive;
+        if (settings.context_policy) ui.contextPolicySelector.value = settings.context_policy;
+        if (settings.image_turns) ui.imageTurnsSelector.value = settings.image_turns;
+        if (settings.response_cache) ui.responseCacheSelector.value = settings.response_cache;
+        if (settings.fast_model !== undefined) ui.fastModelSelector.value = settings.fast_model;
         updateSlider(document.getElementById('speed-slider'), document.getElementById('speed-value'), settings.tts_speed, v => `${parseFloat(v).toFixed(1)}x`);
         updateSlider(ui.numCtxSlider, ui.numCtxValue, settings.num_ctx, v => v); updateSlider(ui.temperatureSlider, ui.temperatureValue, settings.temperature, v => parseFloat(v).toFixed(2));
         updateSlider(ui.topPSlider, ui.topPValue, settings.top_p, v => parseFloat(v).toFixed(2));
@@ -1357,7 +2480,11 @@ HTML_TEMPLATE = """
         const settings = {
             model: ui.modelSelector.value, tts_lang: ui.languageSelector.value, tts_voice: ui.voiceSelector.value, tts_speed: ui.speedSlider.value,
             system_message: ui.systemMessageInput.value, tts_enabled: ui.ttsEnabledSelector.value, temperature: ui.temperatureSlider.value,
-            top_p: ui.topPSlider.value, num_ctx: ui.numCtxSlider.value
+            top_p: ui.topPSlider.value, num_ctx: ui.numCtxSlider.value, whisper_model: ui.whisperModelSelector.value,
+            stt_profile: ui.sttProfileSelector.value, barge_in: ui.bargeInSelector.value,
+            two_pass_stt: ui.twoPassSelector.value, keep_alive: ui.keepAliveSelector.value,
+            context_policy: ui.contextPolicySelector.value, image_turns: ui.imageTurnsSelector.value,
+            response_cache: ui.responseCacheSelector.value, fast_model: ui.fastModelSelector.value
         };
         await fetch('/save_settings', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(settings) });
     }
@@ -1372,12 +2499,20 @@ HTML_TEMPLATE = """
                     if (res.ok) resolve(result.images); else reject(new Error(result.error || 'PDF conversion failed.'));
                 } catch (error) { reject(error); }
             } else {
-                const reader = new FileReader();
-                reader.onload = () => resolve([reader.result]); reader.onerror = reject; reader.readAsDataURL(file);
+                try { resolve(await uploadImage(file)); } catch (error) { reject(error); }
             }
         }))).then(results => { imageBase64Array.push(...results.flat()); updatePreviews(); ui.fileInput.value = ''; }).catch(error => alert(`Error: ${error.message}`));
     }
     
+    // Images are stored on the server once and referenced by URL in the chat history
+    async function uploadImage(blob) {
+        const formData = new FormData(); formData.append('image_file', blob);
+        const res = await fetch('/images', { method: 'POST', body: formData });
+        const result = await res.json();
+        if (!res.ok) throw new Error(result.error || 'Image upload failed.');
+        return result.images;
+    }
+
     function updatePreviews() {
         ui.previewContainer.innerHTML = '';
         imageBase64Array.forEach((base64String, index) => {
@@ -1421,12 +2556,14 @@ HTML_TEMPLATE = """
         ui.webcamCanvas.width = ui.webcamFeed.videoWidth; 
         ui.webcamCanvas.height = ui.webcamFeed.videoHeight;
         context.drawImage(ui.webcamFeed, 0, 0, ui.webcamCanvas.width, ui.webcamCanvas.height);
-        imageBase64Array.push(ui.webcamCanvas.toDataURL('image/jpeg')); 
-        updatePreviews();
+        ui.webcamCanvas.toBlob(async (blob) => {
+            try { imageBase64Array.push(...await uploadImage(blob)); updatePreviews(); }
+            catch (error) { alert(`Error: ${error.message}`); }
+        }, 'image/jpeg');
     }
     
     async function startNewChat() {
-        conversationHistory = []; currentChatId = 'new'; ui.messageContainer.innerHTML = '';
+        conversationHistory = []; currentChatId = 'new'; ui.messageContainer.innerHTML = ''; ui.prefillStatus.classList.add('hidden'); ui.cacheWarning.classList.add('hidden');
         ui.welcomeScreen.classList.remove('hidden'); ui.messageContainer.classList.add('hidden'); ui.historyPanel.classList.remove('open');
         try {
             const res = await fetch('/get_settings');
@@ -1440,35 +2577,26 @@ HTML_TEMPLATE = """
         return {
             model: ui.modelSelector.value, system_message: ui.systemMessageInput.value, tts_lang: ui.languageSelector.value,
             tts_voice: ui.voiceSelector.value, tts_speed: ui.speedSlider.value, temperature: ui.temperatureSlider.value,
-            top_p: ui.topPSlider.value, num_ctx: ui.numCtxSlider.value, tts_enabled: ui.ttsEnabledSelector.value
+            top_p: ui.topPSlider.value, num_ctx: ui.numCtxSlider.value, tts_enabled: ui.ttsEnabledSelector.value,
+            whisper_model: ui.whisperModelSelector.value, stt_profile: ui.sttProfileSelector.value, barge_in: ui.bargeInSelector.value,
+            two_pass_stt: ui.twoPassSelector.value, keep_alive: ui.keepAliveSelector.value,
+            context_policy: ui.contextPolicySelector.value, image_turns: ui.imageTurnsSelector.value,
+            response_cache: ui.responseCacheSelector.value, fast_model: ui.fastModelSelector.value
         };
     }
     
-    async function saveOrUpdateCurrentChat() {
-        if (!conversationHistory || conversationHistory.length === 0) return;
-        const currentSettings = getCurrentUISettings();
-        if (currentChatId === 'new') {
-            const firstUserMessage = conversationHistory.find(m => m.role === 'user');
-            const title = firstUserMessage ? (firstUserMessage.content || 'Image Query').substring(0, 40) : 'Untitled Chat';
-            const newChatSession = { id: `chat-${Date.now()}`, timestamp: new Date().toISOString(), title: title, history: conversationHistory, settings: currentSettings };
-            try {
-                const res = await fetch(`/conversations`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(newChatSession) });
-                const savedSession = await res.json();
-                if (res.ok) { savedHistories.unshift(savedSession); currentChatId = savedSession.id; }
-            } catch (err) { console.error('Error saving new chat:', err); }
+    // The server saves each turn itself. This keeps the local list of saved chats up to date.
+    function recordSavedChat(chatId) {
+        if (currentChatId === 'new') currentChatId = chatId;
+        let chat = savedHistories.find(c => c.id === chatId);
+        if (chat) {
+            savedHistories.splice(savedHistories.indexOf(chat), 1);
         } else {
-            try {
-                const res = await fetch(`/conversations/${currentChatId}`, { method: 'PUT', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ history: conversationHistory, settings: currentSettings }) });
-                if (res.ok) {
-                    const chatIndex = savedHistories.findIndex(c => c.id === currentChatId);
-                    if (chatIndex !== -1) {
-                        const updatedChat = savedHistories[chatIndex];
-                        updatedChat.history = conversationHistory; updatedChat.settings = currentSettings; updatedChat.timestamp = new Date().toISOString();
-                        savedHistories.splice(chatIndex, 1); savedHistories.unshift(updatedChat);
-                    }
-                }
-            } catch (err) { console.error('Error updating chat:', err); }
+            const firstUserMessage = conversationHistory.find(m => m.role === 'user');
+            chat = { id: chatId, title: firstUserMessage ? (firstUserMessage.content || 'Image Query').substring(0, 40) : 'Untitled Chat' };
         }
+        Object.assign(chat, { timestamp: new Date().toISOString(), history: conversationHistory, settings: getCurrentUISettings() });
+        savedHistories.unshift(chat);
     }
     
     function renderSavedChatsList() {
@@ -1502,7 +2630,10 @@ HTML_TEMPLATE = """
             conversationHistory = JSON.parse(JSON.stringify(chatToLoad.history));
             currentChatId = chatToLoad.id;
             ui.messageContainer.innerHTML = ''; conversationHistory.forEach(msg => addMessage(msg));
+            ui.cacheWarning.classList.add('hidden');
             ui.historyPanel.classList.remove('open');
+            // Evaluate the restored history in the background so the first follow-up answers quickly
+            requestPrefill('load');
         }
     }
 
@@ -1531,7 +2662,7 @@ HTML_TEMPLATE = """
 @app.route("/")
 def index():
     current_user_settings = load_settings()
-    template = render_template_string(HTML_TEMPLATE, model_list=model_list, current_model=OLLAMA_MODEL, saved_settings=current_user_settings)
+    template = render_template_string(HTML_TEMPLATE, model_list=model_list, current_model=OLLAMA_MODEL, saved_settings=current_user_settings, whisper_model_sizes=WHISPER_MODEL_SIZES)
     response = Response(template)
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0, private"
     response.headers["Pragma"] = "no-cache"
@@ -1547,13 +2678,32 @@ def save_all_settings():
     global OLLAMA_MODEL
     new_settings = request.json
     new_model = new_settings.get("model")
+    settings = load_settings()
+    reload_needed = any(key in new_settings and str(new_settings[key]) != str(settings.get(key)) for key in ("num_ctx", "keep_alive"))
     if new_model and new_model in model_list and new_model != OLLAMA_MODEL:
         OLLAMA_MODEL = new_model
-    settings = load_settings()
+        reload_needed = True
     settings.update(new_settings)
     save_settings(settings)
+    if reload_needed: request_model_preload(OLLAMA_MODEL, settings.get("num_ctx", DEFAULT_NUM_CTX), settings.get("keep_alive", DEFAULT_KEEP_ALIVE))
     return jsonify({"status": "success"})
 
+@app.route("/model_status", methods=["GET"])
+def get_model_status():
+    return jsonify(model_status)
+
+@app.route("/models", methods=["GET"])
+def get_models():
+    return jsonify(get_model_registry())
+
+@app.route("/health", methods=["GET"])
+def get_health():
+    return jsonify(get_backend_health())
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return jsonify({"summary": summarize_turn_metrics(), "recent": list(recent_turn_metrics)[-50:]})
+
 @app.route("/upload_pdf", methods=["POST"])
 def upload_pdf():
     if 'pdf_file' not in request.files: return jsonify({"error": "No PDF file part."}), 400
@@ -1567,178 +2717,940 @@ def upload_pdf():
             img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
             byte_io = io.BytesIO()
             img.save(byte_io, 'JPEG', quality=90)
-            images.append(f"data:image/jpeg;base64,{base64.b64encode(byte_io.getvalue()).decode('utf-8')}")
+            images.append(store_image(byte_io.getvalue()))
         doc.close()
         return jsonify({"images": images})
     except Exception as e:
         return jsonify({"error": f"Failed to process PDF: {str(e)}"}), 500
 		
+@app.route("/images", methods=["POST"])
+def upload_images():
+    files = request.files.getlist('image_file')
+    if not files: return jsonify({"error": "No image file."}), 400
+    if any(f.mimetype not in IMAGE_EXTENSIONS for f in files): return jsonify({"error": "Unsupported image type."}), 400
+    return jsonify({"images": [store_image(f.read(), f.mimetype) for f in files]})
+
+@app.route("/images/<name>", methods=["GET"])
+def get_image(name):
+    # Names are content hashes, so the browser can cache them for good
+    return send_from_directory(IMAGE_STORE_DIR, name, max_age=31536000)
+
 @app.route("/transcribe", methods=["POST"])
 def transcribe_audio():
     if 'audio_data' not in request.files: return jsonify({"error": "No audio file."}), 400
-    temp_audio_path = "temp_recording.wav"
-    try:
-        audio_file = request.files['audio_data']; audio_file.save(temp_audio_path)
-        result = whisper_model.transcribe(temp_audio_path, fp16=False)
-        user_transcript = result["text"].strip()
-        if has_repeated_phrases(user_transcript) or contains_mixed_scripts(user_transcript):
-            user_transcript = ""
-        return jsonify({"transcribedText": user_transcript})
-    except Exception as e:
+    settings = load_settings()
+    tts_lang = request.form.get("tts_lang") or settings.get("tts_lang")
+    if request.form.get("pass") == "draft":
+        whisper_model_name = get_draft_whisper_model(tts_lang)
+        stt_profile = DRAFT_STT_PROFILE
+    else:
+        whisper_model_name = request.form.get("whisper_model") or settings.get("whisper_model", WHISPER_MODEL)
+        stt_profile = request.form.get("stt_profile") or settings.get("stt_profile", DEFAULT_STT_PROFILE)
+    if whisper_model_name not in WHISPER_MODEL_SIZES: return jsonify({"error": f"Unknown Whisper model: {whisper_model_name}"}), 400
+    language = get_stt_language(tts_lang, whisper_model_name)
+    stt_options = get_stt_options(settings, stt_profile, language)
+    job = {"audio": request.files['audio_data'].read(), "model": whisper_model_name, "options": stt_options,
+           "done": threading.Event(), "result": None}
+    queued_time = time.perf_counter()
+    try: stt_job_queue.put_nowait(job)
+    except queue.Full: return jsonify({"error": "Speech recognition is busy. Please try again in a moment."}), 503
+    if not job["done"].wait(STT_REQUEST_TIMEOUT): return jsonify({"error": "Transcription timed out."}), 504
+    result = job["result"]
+    if "error" in result:
+        print(f"[ERROR] Transcription failed: {result['error']}", file=sys.stderr)
         return jsonify({"error": "Internal server error."}), 500
-    finally:
-        if os.path.exists(temp_audio_path): os.remove(temp_audio_path)
+    total_time = time.perf_counter() - queued_time
+    print(f"[STT] Model: {whisper_model_name} | Profile: {stt_profile} | Language: {language or 'auto'} | "
+          f"Audio: {result['audio_seconds']:.1f}s | Load: {result['load_time']:.2f}s | "
+          f"Transcribe: {result['transcribe_time']:.2f}s | Batch: {result['batch_size']} | Total (incl. queue): {total_time:.2f}s")
+    return jsonify({"transcribedText": result["text"]})
 
 # --- Conversation History Routes ---
 @app.route("/conversations", methods=["GET"])
-def get_all_conversations(): return jsonify(load_conversations())
+def get_all_conversations():
+    with conversations_lock: return jsonify(load_conversations())
 
 @app.route("/conversations", methods=["POST"])
 def save_new_conversation():
     new_chat_session = request.json
     if not all(k in new_chat_session for k in ['id', 'timestamp', 'title', 'history', 'settings']): return jsonify({"error": "Invalid chat session format"}), 400
-    conversations = load_conversations()
-    conversations.insert(0, new_chat_session)
-    save_conversations(conversations)
+    with conversations_lock:
+        conversations = load_conversations()
+        conversations.insert(0, new_chat_session)
+        save_conversations(conversations)
     return jsonify(new_chat_session), 201
 
 @app.route("/conversations/<chat_id>", methods=["PUT"])
 def update_existing_conversation(chat_id):
-    updated_data = request.json; conversations = load_conversations()
-    chat_index = next((i for i, chat in enumerate(conversations) if chat.get('id') == chat_id), -1)
-    if chat_index != -1:
-        updated = False
-        if 'history' in updated_data and 'settings' in updated_data:
-            conversations[chat_index]['history'] = updated_data['history']
-            conversations[chat_index]['settings'] = updated_data['settings']
-            updated = True
-        if 'title' in updated_data:
-            new_title = updated_data['title'].strip()
-            if new_title: conversations[chat_index]['title'] = new_title; updated = True
-        if updated:
-            conversations[chat_index]['timestamp'] = datetime.now(timezone.utc).isoformat()
-            updated_chat = conversations.pop(chat_index); conversations.insert(0, updated_chat)
-            save_conversations(conversations)
-            return jsonify({"status": "updated"})
-        return jsonify({"error": "No valid update data provided"}), 400
+    updated_data = request.json
+    with conversations_lock:
+        conversations = load_conversations()
+        chat_index = next((i for i, chat in enumerate(conversations) if chat.get('id') == chat_id), -1)
+        if chat_index != -1:
+            updated = False
+            if 'history' in updated_data and 'settings' in updated_data:
+                conversations[chat_index]['history'] = updated_data['history']
+                conversations[chat_index]['settings'] = updated_data['settings']
+                updated = True
+            if 'title' in updated_data:
+                new_title = updated_data['title'].strip()
+                if new_title: conversations[chat_index]['title'] = new_title; updated = True
+            if updated:
+                conversations[chat_index]['timestamp'] = datetime.now(timezone.utc).isoformat()
+                updated_chat = conversations.pop(chat_index); conversations.insert(0, updated_chat)
+                save_conversations(conversations)
+                return jsonify({"status": "updated"})
+            return jsonify({"error": "No valid update data provided"}), 400
     return jsonify({"error": "History not found"}), 404
 
 @app.route("/conversations/<chat_id>", methods=["DELETE"])
 def delete_existing_conversation(chat_id):
-    conversations = load_conversations(); initial_len = len(conversations)
-    conversations = [chat for chat in conversations if chat.get('id') != chat_id]
-    if len(conversations) < initial_len:
-        save_conversations(conversations)
-        return jsonify({"status": "deleted"})
+    with conversations_lock:
+        conversations = load_conversations(); initial_len = len(conversations)
+        conversations = [chat for chat in conversations if chat.get('id') != chat_id]
+        if len(conversations) < initial_len:
+            save_conversations(conversations)
+            return jsonify({"status": "deleted"})
     return jsonify({"error": "History not found"}), 404
 
 		
+def canonical_text(text):
+    # Ollama reuses its KV cache only for an identical token prefix, so stray whitespace or
+    # line ending differences between turns must not reach the prompt.
+    text = (text or "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip()
+
+def build_messages(system_message, history):
+    messages = [{"role": "system", "content": canonical_text(system_message)}]
+    for msg in history:
+        ollama_msg = {"role": msg["role"], "content": canonical_text(msg.get("content", ""))}
+        images = [data for data in (resolve_image(img) for img in msg.get("images", [])) if data is not None]
+        if images: ollama_msg["images"] = images
+        messages.append(ollama_msg)
+    return messages
+
+def build_llm_options(llm_options):
+    return {
+        "num_ctx": int(llm_options.get("num_ctx", DEFAULT_NUM_CTX)),
+        "temperature": float(llm_options.get("temperature", 1.0)),
+        "top_p": float(llm_options.get("top_p", DEFAULT_TOP_P)),
+    }
+
+
+# --- Image Aging ---
+# Every image in the history used to be sent on every turn, so a PDF dropped early in a chat made each
+# later turn re-run the vision encoder on all of its pages. Only the last few user turns now keep their
+# images. Older images are replaced by a caption, made once by the chat model after a reply has finished.
+# The captions are saved with the message (image_captions) and also cached here by image hash.
+image_captions = {} # sha1 of the image data URL -> caption
+captions_in_progress = set()
+captions_lock = threading.Lock()
+
+def image_key(img):
+    return hashlib.sha1(img.encode("utf-8")).hexdigest()
+
+def age_out_images(history, image_turns):
+    # Returns the history to send and the indexes of aged-out messages whose captions the client hasn't stored yet
+    if str(image_turns) == "all": return history, []
+    user_turns = [i for i, msg in enumerate(history) if msg["role"] == "user"]
+    keep_turns = max(1, int(image_turns))
+    if len(user_turns) <= keep_turns: return history, []
+    first_kept = user_turns[-keep_turns]
+    aged, uncaptioned = [], []
+    for i, msg in enumerate(history):
+        if i >= first_kept or not msg.get("images"):
+            aged.append(msg); continue
+        captions = msg.get("image_captions") or []
+        if len(captions) != len(msg["images"]):
+            uncaptioned.append(i)
+            with captions_lock: captions = [image_captions.get(image_key(img)) for img in msg["images"]]
+        if not all(captions): # Keep the images until every caption is ready
+            aged.append(msg); continue
+        caption_text = "\n".join(f"[Image {j + 1}: {caption}]" for j, caption in enumerate(captions))
+        aged.append({"role": msg["role"], "content": f"{caption_text}\n{msg.get('content', '')}".strip()})
+    return aged, uncaptioned
+
+def caption_images(history, indexes, model, options, keep_alive, sid, chat_id):
+    for i in indexes:
+        captions = []
+        for img in history[i]["images"]:
+            key = image_key(img)
+            with captions_lock:
+                caption = image_captions.get(key)
+                if caption is None:
+                    if key in captions_in_progress: break # Another turn is captioning this image
+                    captions_in_progress.add(key)
+            if caption is None:
+                try:
+                    start_time = time.perf_counter()
+                    image_data = resolve_image(img)
+                    if image_data is None: raise FileNotFoundError(f"image '{img}' is missing")
+                    response = run_in_background_slot(lambda: llm_backend.chat(model, [{"role": "user", "content": IMAGE_CAPTION_PROMPT, "images": [image_data]}],
+                                                                               {**options, "num_predict": CAPTION_MAX_TOKENS}, keep_alive))
+                    caption = response["message"]["content"].strip()
+                    with captions_lock: image_captions[key] = caption
+                    print(f"[CAPTION] Captioned an image in {time.perf_counter() - start_time:.1f}s.")
+                except Exception as e:
+                    print(f"[ERROR] Could not caption an image: {e}", file=sys.stderr)
+                finally:
+                    with captions_lock: captions_in_progress.discard(key)
+            if not caption: break
+            captions.append(caption)
+        if len(captions) == len(history[i]["images"]):
+            save_image_captions(chat_id, i, captions)
+            socketio.emit('image_captions', {'chat_id': chat_id, 'index': i, 'captions': captions}, room=sid)
+
+def start_image_captioning(data, uncaptioned, model, options, keep_alive, sid):
+    if not uncaptioned: return
+    threading.Thread(target=caption_images, args=(data.get("history", []), uncaptioned, model, options, keep_alive, sid, data.get("chat_id")), daemon=True).start()
+
+
+# --- Context Management ---
+# Fits the history into a token budget (a share of num_ctx) so prompt evaluation stays steady in long
+# chats instead of growing until it silently overflows num_ctx. Token counts are estimated and cached
+# by message hash. Policies: sliding_window keeps the newest messages, pin_first also keeps the first
+# exchange, and summary replaces the dropped messages with a rolling summary made in the background.
+token_count_cache = OrderedDict()
+token_count_lock = threading.Lock()
+conversation_summaries = {} # hash of the summarized messages -> summary text
+summaries_in_progress = set()
+summaries_lock = threading.Lock()
+
+def message_hash(msg):
+    h = hashlib.sha1()
+    h.update(f"{msg['role']}\0{msg.get('content', '')}".encode("utf-8"))
+    for img in msg.get("images", []): h.update(b"\0" + (img.encode("utf-8") if isinstance(img, str) else img))
+    return h.hexdigest()
+
+def count_message_tokens(msg):
+    key = message_hash(msg)
+    with token_count_lock:
+        count = token_count_cache.get(key)
+        if count is not None:
+            token_count_cache.move_to_end(key)
+            return count
+    count = (MESSAGE_TOKEN_OVERHEAD + math.ceil(len(msg.get("content", "")) / CHARS_PER_TOKEN)
+             + IMAGE_TOKEN_ESTIMATE * len(msg.get("images", [])))
+    with token_count_lock:
+        token_count_cache[key] = count
+        if len(token_count_cache) > 5000: token_count_cache.popitem(last=False)
+    return count
+
+def choose_history_cut(history, counts, start, available):
+    # Returns the index of the first history message to keep after `start`. Whole blocks of
+    # CONTEXT_TRIM_STEP messages are dropped where possible so the cut doesn't move on every turn.
+    suffix = [0] * (len(counts) + 1)
+    for i in reversed(range(len(counts))): suffix[i] = suffix[i + 1] + counts[i]
+    for cut in range(start, len(counts), CONTEXT_TRIM_STEP):
+        if suffix[cut] <= available and history[cut]["role"] == "user": return cut
+    for cut in range(start, len(counts)):
+        if suffix[cut] <= available and history[cut]["role"] == "user": return cut
+    return len(counts) - 1 # The newest message is always kept
+
+def summarize_messages(key, previous_summary, new_messages, model, num_ctx, keep_alive):
+    try:
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m.get('content', '')}" + " [image]" * len(m.get("images", [])) for m in new_messages)
+        prompt = ("Summarize this conversation between a user and an assistant in a short paragraph. "
+                  "Keep names, facts, decisions and open questions.")
+        if previous_summary: prompt += f"\n\nSummary of the conversation before this part:\n{previous_summary}"
+        prompt += f"\n\nConversation:\n{transcript}"
+        start_time = time.perf_counter()
+        response = run_in_background_slot(lambda: llm_backend.chat(model, [{"role": "user", "content": prompt}], {"num_ctx": num_ctx, "num_predict": SUMMARY_MAX_TOKENS, "temperature": 0.3}, keep_alive))
+        with summaries_lock:
+            conversation_summaries[key] = response["message"]["content"].strip()
+            while len(conversation_summaries) > 200: conversation_summaries.pop(next(iter(conversation_summaries)))
+        print(f"[CONTEXT] Summarized {len(new_messages)} messages in {time.perf_counter() - start_time:.1f}s.")
+    except Exception as e:
+        print(f"[ERROR] Could not summarize the conversation: {e}", file=sys.stderr)
+    finally:
+        with summaries_lock: summaries_in_progress.discard(key)
+
+def get_conversation_summary(dropped, model, num_ctx, keep_alive):
+    # Returns the best summary available now. If the summary of all dropped messages isn't ready, one is
+    # started in the background (extending the newest existing summary) and that older summary is used.
+    prefix_keys, h = [], hashlib.sha1()
+    for msg in dropped:
+        h.update(message_hash(msg).encode("ascii"))
+        prefix_keys.append(h.hexdigest())
+    with summaries_lock:
+        if prefix_keys[-1] in conversation_summaries: return conversation_summaries[prefix_keys[-1]]
+        done = next((j for j in range(len(prefix_keys) - 1, -1, -1) if prefix_keys[j] in conversation_summaries), None)
+        previous_summary = conversation_summaries[prefix_keys[done]] if done is not None else None
+        if prefix_keys[-1] not in summaries_in_progress:
+            summaries_in_progress.add(prefix_keys[-1])
+            new_messages = dropped[done + 1:] if done is not None else dropped
+            threading.Thread(target=summarize_messages, args=(prefix_keys[-1], previous_summary, new_messages, model, num_ctx, keep_alive), daemon=True).start()
+    return previous_summary
+
+def fit_context(messages, options, policy, budget_fraction, model, keep_alive):
+    num_ctx = options.get("num_ctx", 0)
+    counts = [count_message_tokens(m) for m in messages]
+    budget = int(num_ctx * budget_fraction)
+    if num_ctx <= 0 or sum(counts) <= budget or len(messages) <= 2: return messages
+    system, history, history_counts = messages[0], messages[1:], counts[1:]
+    pinned = min(CONTEXT_PINNED_MESSAGES, len(history) - 1) if policy == "pin_first" else 0
+    available = budget - counts[0] - sum(history_counts[:pinned]) - (SUMMARY_MAX_TOKENS if policy == "summary" else 0)
+    cut = choose_history_cut(history, history_counts, pinned, available)
+    dropped = history[pinned:cut]
+    if policy == "summary" and dropped:
+        summary = get_conversation_summary(dropped, model, num_ctx, keep_alive)
+        if summary: system = {**system, "content": f"{system['content']}\n\nSummary of the earlier conversation: {summary}"}
+    fitted = [system] + history[:pinned] + history[cut:]
+    print(f"[CONTEXT] Policy: {policy} | Kept {len(fitted) - 1}/{len(history)} messages | "
+          f"Estimated tokens: {sum(count_message_tokens(m) for m in fitted)}/{budget}")
+    return fitted
+
+def prepare_messages(data, options, model, keep_alive):
+    # Returns the messages to send and the indexes of history messages still waiting for image captions
+    settings = load_settings()
+    history, uncaptioned = age_out_images(data.get("history", []), data.get("image_turns") or settings.get("image_turns", DEFAULT_IMAGE_TURNS))
+    messages = build_messages(data.get("system_message", DEFAULT_SYSTEM_MESSAGE), history)
+    policy = data.get("context_policy") or settings.get("context_policy", DEFAULT_CONTEXT_POLICY)
+    return fit_context(messages, options, policy, float(settings.get("context_budget", CONTEXT_BUDGET_FRACTION)), model, keep_alive), uncaptioned
+
+
+# --- Prompt Prefill ---
+# While the user is still speaking or typing, the unchanged part of the prompt (system message and
+# history) is sent to Ollama with a one-token generation. Ollama keeps the evaluated prompt in its cache,
+# so the real turn only has to evaluate the new user message. (num_predict 0 means "no limit" in Ollama.)
+prefilled_prompts = {} # sid -> key of the prompt that Ollama most likely has cached for this client
+
+def prompt_key(model, messages, options):
+    return hashlib.sha256(json.dumps([model, messages, options], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# --- Prompt Prefix Tracking ---
+# Ollama keeps the KV cache of the last prompt per loaded model and only re-evaluates the part after
+# the longest common prefix. The last prompt sent for each client is remembered so every request can
+# log how much of it was likely reused, and why not when the cache was lost.
+last_prompts = {} # sid -> {"model", "num_ctx", "hashes"} of the last prompt sent for this client
+
+def check_prompt_prefix(sid, model, options, messages, label):
+    hashes = [message_hash(m) for m in messages]
+    previous = last_prompts.get(sid)
+    common = 0
+    if previous is None: reason = "first request"
+    elif previous["model"] != model: reason = f"model changed from {previous['model']}"
+    elif previous["num_ctx"] != options.get("num_ctx"): reason = "context size changed"
+    else:
+        for old, new in zip(previous["hashes"], hashes):
+            if old != new: break
+            common += 1
+        if common == len(hashes) or common == len(previous["hashes"]): reason = None
+        elif common == 0: reason = "system message changed"
+        else: reason = f"history differs from message {common}"
+    reused = sum(count_message_tokens(m) for m in messages[:common])
+    total = sum(count_message_tokens(m) for m in messages)
+    print(f"[PREFIX] {label}: ~{reused}/{total} prompt tokens reusable ({reason or 'likely cache hit'})")
+    return reused
+
+def remember_prompt(sid, model, options, messages):
+    last_prompts[sid] = {"model": model, "num_ctx": options.get("num_ctx"), "hashes": [message_hash(m) for m in messages]}
+
+@socketio.on('prefill')
+def handle_prefill(data):
+    sid = request.sid
+    model = data.get("model", OLLAMA_MODEL)
+    options = build_llm_options(data.get("llm_options", {}))
+    keep_alive = parse_keep_alive(load_settings().get("keep_alive"))
+    history = get_conversation_history(data.get("chat_id"))
+    if len(history) != data.get("history_length", 0): return # The client's copy of the chat differs from the saved one
+    if is_generation_queue_busy(): return # Replies come first. The prompt is evaluated with the next turn instead.
+    if not is_backend_healthy(): return
+    data = {**data, "history": history}
+    messages, uncaptioned = prepare_messages(data, options, model, keep_alive)
+    key = prompt_key(model, messages, options)
+    status = {'reason': data.get("reason"), 'chat_id': data.get("chat_id")}
+    if prefilled_prompts.get(sid) == key:
+        socketio.emit('prefill_status', {**status, 'state': 'cached'}, room=sid)
+        start_image_captioning(data, uncaptioned, model, options, keep_alive, sid)
+        return
+    prefilled_prompts[sid] = key
+    check_prompt_prefix(sid, model, options, messages, "Prefill")
+    remember_prompt(sid, model, options, messages)
+    socketio.emit('prefill_status', {**status, 'state': 'running'}, room=sid)
+    start_time = time.perf_counter()
+    try:
+        response = llm_backend.chat(model, messages, {**options, "num_predict": 1}, keep_alive)
+        prompt_tokens = response.get('prompt_eval_count') or 0
+        prompt_eval_ms = (response.get('prompt_eval_duration') or 0) / 1e6
+        print(f"[PREFILL] Reason: {status['reason']} | Model: {model} | Prompt tokens evaluated: {prompt_tokens} | Prompt eval: {prompt_eval_ms:.0f} ms | "
+              f"Total: {time.perf_counter() - start_time:.2f}s")
+        socketio.emit('prefill_status', {**status, 'state': 'done', 'prompt_tokens': prompt_tokens, 'prompt_eval_ms': round(prompt_eval_ms)}, room=sid)
+    except Exception as e:
+        prefilled_prompts.pop(sid, None)
+        last_prompts.pop(sid, None)
+        print(f"[ERROR] Prefill failed: {e}", file=sys.stderr)
+        socketio.emit('prefill_status', {**status, 'state': 'error'}, room=sid)
+    start_image_captioning(data, uncaptioned, model, options, keep_alive, sid)
+
+
+# --- Speculative Turns (Two-Pass STT) ---
+# A turn started from a draft transcript generates as usual, but its events are held back until the
+# final transcript arrives. If it matches the draft the held events are released, otherwise the turn is
+# cancelled and the client starts a new turn with the final transcript.
+speculative_turns = {} # sid -> {"turn_id", "draft", "state": pending/confirmed/rejected, "events", "finished", "final", "save"}
+early_confirmations = {} # sid -> {"turn_id", "text"} of a confirm_draft that arrived before its turn was registered
+speculative_turns_lock = threading.Lock()
+
+def register_speculative_turn(sid, turn_id, draft):
+    # The final transcript can arrive while the chat_message handler is still loading the conversation (or
+    # waiting for a resync after history_mismatch). Such an early confirm_draft is applied here.
+    with speculative_turns_lock:
+        turn = speculative_turns[sid] = {"turn_id": turn_id, "draft": draft, "state": "pending", "events": [], "finished": False}
+        early = early_confirmations.pop(sid, None)
+        if early is not None and early["turn_id"] == turn_id: confirm_speculative_turn(sid, turn, early["text"])
+
+def emit_turn_event(event, payload, sid):
+    with speculative_turns_lock:
+        turn = speculative_turns.get(sid)
+        if turn is not None and turn["turn_id"] == payload.get("turn_id"):
+            if turn["state"] == "pending": turn["events"].append((event, payload))
+            elif turn["state"] == "confirmed": socketio.emit(event, payload, room=sid) # Under the lock to keep the order
+            return
+    socketio.emit(event, payload, room=sid)
+
+def is_turn_rejected(sid, turn_id):
+    turn = speculative_turns.get(sid)
+    return turn is not None and turn["turn_id"] == turn_id and turn["state"] == "rejected"
+
+def save_turn_when_confirmed(sid, turn_id, save):
+    # Saves the turn now, or once its draft transcript is confirmed. Rejected turns are never saved.
+    with speculative_turns_lock:
+        turn = speculative_turns.get(sid)
+        if turn is not None and turn["turn_id"] == turn_id:
+            if turn["state"] == "pending": turn["save"] = save
+            elif turn["state"] == "confirmed": save(turn["final"])
+            return
+    save(None)
+
+def finish_speculative_turn(sid, turn_id):
+    with speculative_turns_lock:
+        turn = speculative_turns.get(sid)
+        if turn is None or turn["turn_id"] != turn_id: return
+        turn["finished"] = True
+        if turn["state"] != "pending": del speculative_turns[sid]
+
+def confirm_speculative_turn(sid, turn, text):
+    # Called with speculative_turns_lock held
+    similarity = transcript_similarity(turn["draft"], text)
+    accepted = similarity >= TWO_PASS_MIN_SIMILARITY
+    print(f"[STT] Draft transcript {'accepted' if accepted else 'rejected'} (similarity {similarity:.2f})")
+    turn["state"] = "confirmed" if accepted else "rejected"
+    turn["final"] = text
+    socketio.emit('draft_result', {'turn_id': turn["turn_id"], 'accepted': accepted}, room=sid)
+    if accepted:
+        if turn.get("save"): turn["save"](turn["final"]) # Before chat_end reaches the client
+        for event, payload in turn["events"]: socketio.emit(event, payload, room=sid)
+    turn["events"] = []
+    if turn["finished"]: del speculative_turns[sid]
+
+@socketio.on('confirm_draft')
+def handle_confirm_draft(data):
+    sid = request.sid
+    turn_id, text = data.get("turn_id"), data.get("text", "")
+    with speculative_turns_lock:
+        turn = speculative_turns.get(sid)
+        if turn is not None and turn["turn_id"] == turn_id:
+            if turn["state"] == "pending": confirm_speculative_turn(sid, turn, text)
+            return
+        early_confirmations[sid] = {"turn_id": turn_id, "text": text} # The turn isn't registered yet
+
+
+# --- Generation Scheduler ---
+# Replies wait for one of GENERATION_SLOTS slots instead of all hitting Ollama at once. Waiting clients
+# are served round-robin by sid and are told their queue position. When the estimated wait is over
+# GENERATION_MAX_WAIT the reply is turned away, so the time to first token stays bounded under load.
+# The scheduler state is only touched on the generation loop thread.
+class GenerationQueueFull(Exception): pass
+
+running_generations = 0
+waiting_generations = OrderedDict() # sid -> deque of {"turn_id", "future"}
+average_generation_seconds = GENERATION_INITIAL_ESTIMATE
+
+def is_generation_queue_busy():
+    return running_generations >= GENERATION_SLOTS or bool(waiting_generations)
+
+def estimated_generation_wait(position):
+    return position / GENERATION_SLOTS * average_generation_seconds
+
+def notify_queue_positions():
+    queues, depth, position = list(waiting_generations.items()), 0, 0
+    while any(depth < len(waiters) for _, waiters in queues):
+        for sid, waiters in queues:
+            if depth >= len(waiters): continue
+            position += 1
+            socketio.emit('queue_status', {'turn_id': waiters[depth]["turn_id"], 'position': position,
+                                           'estimated_wait': round(estimated_generation_wait(position))}, room=sid)
+        depth += 1
+
+async def acquire_generation_slot(sid, turn_id):
+    global running_generations
+    if running_generations < GENERATION_SLOTS and not waiting_generations:
+        running_generations += 1
+        return
+    position = sum(len(waiters) for waiters in waiting_generations.values()) + 1
+    if estimated_generation_wait(position) > GENERATION_MAX_WAIT:
+        print(f"[QUEUE] Turned away a reply: {position - 1} already waiting.")
+        raise GenerationQueueFull("The assistant is busy with other conversations. Please try again in a moment.")
+    waiter = {"turn_id": turn_id, "future": generation_loop.create_future()}
+    waiting_generations.setdefault(sid, deque()).append(waiter)
+    notify_queue_positions()
+    start_time = time.perf_counter()
+    try:
+        await waiter["future"]
+    except asyncio.CancelledError:
+        if waiter["future"].done() and not waiter["future"].cancelled(): release_generation_slot() # Granted, then cancelled
+        elif waiter in waiting_generations.get(sid, ()):
+            waiting_generations[sid].remove(waiter)
+            if not waiting_generations[sid]: del waiting_generations[sid]
+            notify_queue_positions()
+        raise
+    print(f"[QUEUE] Reply started after waiting {time.perf_counter() - start_time:.1f}s.")
+
+async def try_acquire_background_slot():
+    global running_generations
+    if running_generations < GENERATION_SLOTS and not waiting_generations:
+        running_generations += 1
+        return True
+    return False
+
+def run_in_background_slot(call):
+    # Captions and summaries take a slot too, so a reply never waits inside Ollama behind one while the
+    # scheduler shows the slot as free. They only take a slot nobody is waiting for, and replies come first.
+    while not asyncio.run_coroutine_threadsafe(try_acquire_background_slot(), generation_loop).result():
+        time.sleep(BACKGROUND_SLOT_POLL)
+    try: return call()
+    finally: generation_loop.call_soon_threadsafe(release_generation_slot)
+
+def release_generation_slot(duration=None):
+    global running_generations, average_generation_seconds
+    if duration is not None: average_generation_seconds = 0.8 * average_generation_seconds + 0.2 * duration
+    running_generations -= 1
+    while waiting_generations and running_generations < GENERATION_SLOTS:
+        sid, waiters = next(iter(waiting_generations.items()))
+        waiter = waiters.popleft()
+        if waiters: waiting_generations.move_to_end(sid) # Round-robin between clients
+        else: del waiting_generations[sid]
+        if waiter["future"].done(): continue
+        waiter["future"].set_result(True)
+        running_generations += 1
+    notify_queue_positions()
+
+
+# --- Generation Tasks ---
+# Replies are streamed by the backend's async client on a dedicated event loop thread, one task per client
+# (sid). Stopping or disconnecting cancels the task, which closes the HTTP stream at once, so the model stops
+# generating tokens nobody will read. The socket handler reads the chunks from a queue, so speech
+# synthesis no longer holds up the stream either.
+generation_loop = None
+active_generations = {} # sid -> {"turn_id", "future", "stopped"}
+generation_lock = threading.Lock()
+
+def start_generation_loop():
+    global generation_loop
+    generation_loop = asyncio.new_event_loop()
+    threading.Thread(target=generation_loop.run_forever, daemon=True).start()
+
+async def stream_chat_task(chunks, sid, turn_id, model, messages, options, keep_alive):
+    await acquire_generation_slot(sid, turn_id)
+    start_time, duration = time.perf_counter(), None
+    try:
+        reply = llm_backend.stream_chat(model, messages, options, keep_alive)
+        try: first_chunk = await asyncio.wait_for(reply.__anext__(), BACKEND_RESPONSE_TIMEOUT)
+        except TimeoutError:
+            error = BackendUnavailable(f"The {llm_backend.name} backend did not start replying within {BACKEND_RESPONSE_TIMEOUT}s. It may be stuck loading the model.")
+            record_backend_failure(error, trip=True)
+            raise error
+        record_backend_success()
+        chunks.put(first_chunk)
+        async for chunk in reply:
+            chunks.put(chunk)
+        duration = time.perf_counter() - start_time # Only finished replies count towards the wait estimate
+    except Exception as e:
+        if is_backend_down_error(e) and not isinstance(e, BackendUnavailable): record_backend_failure(e)
+        raise
+    finally:
+        release_generation_slot(duration)
+
+def stream_chat(sid, turn_id, model, messages, options, keep_alive, idle_timeout=None):
+    # Yields the reply chunks of a generation task registered for this sid. With idle_timeout, {"idle": True}
+    # is yielded whenever no chunk arrives for that many seconds, so the caller can flush what it holds.
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(stream_chat_task(chunks, sid, turn_id, model, messages, options, keep_alive), generation_loop)
+    generation = register_generation(sid, turn_id, future)
+    future.add_done_callback(lambda f: chunks.put(None))
+    try:
+        while True:
+            try: chunk = chunks.get(timeout=idle_timeout)
+            except queue.Empty:
+                yield {"idle": True}
+                continue
+            if chunk is None: break
+            yield chunk
+        if not future.cancelled() and future.exception(): raise future.exception()
+    finally:
+        future.cancel()
+        unregister_generation(sid, generation)
+
+def register_generation(sid, turn_id, future=None):
+    generation = {"turn_id": turn_id, "future": future, "stopped": False}
+    with generation_lock:
+        previous = active_generations.get(sid)
+        if previous and previous["future"]: previous["future"].cancel()
+        active_generations[sid] = generation
+    return generation
+
+def unregister_generation(sid, generation):
+    with generation_lock:
+        if active_generations.get(sid) is generation: del active_generations[sid]
+
+def stop_generation(sid):
+    with generation_lock:
+        generation = active_generations.get(sid)
+        if generation is None: return
+        generation["stopped"] = True
+        if generation["future"]: generation["future"].cancel()
+
+def is_generation_stopped(sid, turn_id):
+    with generation_lock:
+        generation = active_generations.get(sid)
+        return generation is None or generation["turn_id"] != turn_id or generation["stopped"]
+
+
+# --- Model Routing ---
+# Each turn goes either to the selected model or to the fast model, by simple rules. The speed of each
+# model is measured from Ollama's timings, so the log can show roughly how much time the fast model saved.
+model_speeds = {} # model -> {"prompt": tokens/s, "generate": tokens/s}
+
+def route_model(main_model, fast_model, messages, rules):
+    # Returns the model for this turn and the reason
+    if not fast_model or fast_model == main_model or fast_model not in model_list: return main_model, "routing off"
+    if any(m.get("images") for m in messages): return main_model, "images"
+    text = messages[-1].get("content", "")
+    if len(text) > rules.get("max_fast_chars", DEFAULT_ROUTING_RULES["max_fast_chars"]): return main_model, f"long prompt ({len(text)} chars)"
+    lowered = text.casefold()
+    keyword = next((k for k in rules.get("main_model_keywords", []) if re.search(rf"\b{re.escape(k.casefold())}\b", lowered)), None)
+    if keyword: return main_model, f"keyword '{keyword}'"
+    return fast_model, "short text-only turn"
+
+def record_model_speed(model, chunk):
+    speeds = model_speeds.setdefault(model, {})
+    for kind, count_key, duration_key in (("prompt", "prompt_eval_count", "prompt_eval_duration"), ("generate", "eval_count", "eval_duration")):
+        count, seconds = chunk.get(count_key) or 0, (chunk.get(duration_key) or 0) / 1e9
+        if count and seconds:
+            rate = count / seconds
+            speeds[kind] = rate if kind not in speeds else 0.8 * speeds[kind] + 0.2 * rate
+
+def estimate_reply_seconds(model, prompt_tokens, completion_tokens):
+    speeds = model_speeds.get(model, {})
+    if "prompt" not in speeds or "generate" not in speeds: return None
+    return prompt_tokens / speeds["prompt"] + completion_tokens / speeds["generate"]
+
+
+# --- Turn Metrics ---
+# Timings come from the server clock (from receiving chat_message) and from the stats in the final chunk.
+recent_turn_metrics = deque(maxlen=TURN_METRICS_HISTORY)
+
+def build_turn_metrics(model, final_chunk, received_at, first_token_at, first_sentence_at, finished_at):
+    since_received = lambda t: round((t - received_at) * 1000) if t else None
+    metrics = {"timestamp": datetime.now(timezone.utc).isoformat(), "model": model, "cached": bool(final_chunk.get("cached")),
+               "ttft_ms": since_received(first_token_at), "time_to_first_sentence_ms": since_received(first_sentence_at),
+               "total_ms": since_received(finished_at)}
+    if metrics["cached"]: return metrics
+    prompt_tokens, completion_tokens = final_chunk.get("prompt_eval_count") or 0, final_chunk.get("eval_count") or 0
+    prompt_seconds, eval_seconds = (final_chunk.get("prompt_eval_duration") or 0) / 1e9, (final_chunk.get("eval_duration") or 0) / 1e9
+    load_ms = round((final_chunk.get("load_duration") or 0) / 1e6)
+    metrics.update({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                    "prompt_tokens_per_sec": round(prompt_tokens / prompt_seconds, 1) if prompt_seconds else None,
+                    "generation_tokens_per_sec": round(completion_tokens / eval_seconds, 1) if eval_seconds else None,
+                    "load_ms": load_ms, "cold_load": load_ms > COLD_LOAD_THRESHOLD_MS})
+    return metrics
+
+def summarize_turn_metrics():
+    metrics = list(recent_turn_metrics)
+    summary = {"turns": len(metrics), "cached_turns": sum(m["cached"] for m in metrics), "cold_loads": sum(bool(m.get("cold_load")) for m in metrics)}
+    for key in ("ttft_ms", "time_to_first_sentence_ms", "total_ms"):
+        values = sorted(m[key] for m in metrics if m.get(key) is not None)
+        if values: summary[key] = {"p50": values[len(values) // 2], "p95": values[min(len(values) - 1, int(len(values) * 0.95))]}
+    for key in ("prompt_tokens_per_sec", "generation_tokens_per_sec"):
+        values = [m[key] for m in metrics if m.get(key)]
+        if values: summary[key] = round(sum(values) / len(values), 1)
+    return summary
+
+
+# --- Response Cache ---
+# Kiosk and classroom setups get the same questions again and again. When caching is on, a reply is stored
+# under its model, messages and options, and the audio of each sentence under its text and voice. A repeated
+# prompt replays the stored text through the normal streaming path, where the sentences find their audio in
+# the cache, so neither Ollama nor Kokoro is called. Entries expire after RESPONSE_CACHE_MAX_AGE and the
+# least recently used ones are evicted beyond RESPONSE_CACHE_MAX_BYTES.
+response_cache = OrderedDict() # key -> (created, size, value)
+response_cache_bytes = 0
+response_cache_lock = threading.Lock()
+
+def is_response_cacheable(data, options):
+    return load_settings().get("response_cache") == "On" and (options.get("temperature") == 0 or bool(data.get("cacheable")))
+
+def response_cache_key(model, messages, options):
+    normalized = [{"role": m["role"], "content": " ".join(m.get("content", "").split()).casefold(),
+                   "images": [hashlib.sha1(img.encode("utf-8")).hexdigest() for img in m.get("images", [])]} for m in messages]
+    return hashlib.sha256(json.dumps(["reply", model, normalized, options], sort_keys=True).encode("utf-8")).hexdigest()
+
+def audio_cache_key(sentence, voice, speed, lang):
+    return hashlib.sha256(json.dumps(["audio", sentence, voice, speed, lang]).encode("utf-8")).hexdigest()
+
+def cache_lookup(key):
+    global response_cache_bytes
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is None: return None
+        if time.time() - entry[0] > RESPONSE_CACHE_MAX_AGE:
+            response_cache_bytes -= response_cache.pop(key)[1]
+            return None
+        response_cache.move_to_end(key)
+        return entry[2]
+
+def cache_store(key, value):
+    global response_cache_bytes
+    size = len(value)
+    with response_cache_lock:
+        if key in response_cache: response_cache_bytes -= response_cache.pop(key)[1]
+        now = time.time()
+        for expired in [k for k, entry in response_cache.items() if now - entry[0] > RESPONSE_CACHE_MAX_AGE]:
+            response_cache_bytes -= response_cache.pop(expired)[1]
+        response_cache[key] = (now, size, value); response_cache_bytes += size
+        while response_cache_bytes > RESPONSE_CACHE_MAX_BYTES and response_cache:
+            response_cache_bytes -= response_cache.popitem(last=False)[1][1]
+
+def replay_cached_reply(sid, turn_id, text):
+    # Yields a cached reply in the same shape as Ollama's stream
+    generation = register_generation(sid, turn_id)
+    try:
+        for piece in re.findall(r"\s*\S+\s*$|\s*\S+|\s+$", text): yield {"message": {"content": piece}, "done": False}
+        yield {"message": {"content": ""}, "done": True, "cached": True}
+    finally:
+        unregister_generation(sid, generation)
+
+
+# --- Token Batching ---
+# At 50-100 tokens per second a message per token meant thousands of socket frames and browser reflows
+# per reply. Tokens are collected and sent together every TOKEN_FLUSH_MS or TOKEN_FLUSH_CHARS, and always
+# before a sentence goes to speech synthesis so the text isn't held back while it is spoken. If the model
+# pauses, stream_chat wakes the handler after one window so the held text is sent anyway.
+def new_token_batch():
+    return {"text": "", "last_flush": 0.0, "window": float(load_settings().get("token_flush_ms", TOKEN_FLUSH_MS)) / 1000}
+
+def flush_token_batch(batch, sid, turn_id, force=False):
+    now = time.perf_counter()
+    if batch["text"] and (force or now - batch["last_flush"] >= batch["window"] or len(batch["text"]) >= TOKEN_FLUSH_CHARS):
+        emit_turn_event('llm_token', {'token': batch["text"], 'turn_id': turn_id}, sid); socketio.sleep(0)
+        batch["text"], batch["last_flush"] = "", now
+
+
 # --- WebSocket Event Handlers ---
 
 @socketio.on('stop_generation')
 def handle_stop_generation():
-    session['stop_generation'] = True
+    stop_generation(request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    sid = request.sid
+    stop_generation(sid)
+    prefilled_prompts.pop(sid, None)
+    last_prompts.pop(sid, None)
+    with speculative_turns_lock:
+        speculative_turns.pop(sid, None)
+        early_confirmations.pop(sid, None)
 
 @socketio.on('chat_message')
 def handle_chat_message(data):
-    session['stop_generation'] = False
-    history = data.get("history", [])
-    system_message = data.get("system_message", DEFAULT_SYSTEM_MESSAGE)
+    received_at = time.perf_counter()
+    turn_id = data.get("turn_id")
     model = data.get("model", OLLAMA_MODEL)
     tts_enabled = data.get("tts_enabled", "On")
     llm_options = data.get("llm_options", {})
+    keep_alive = parse_keep_alive(load_settings().get("keep_alive"))
+    sid = request.sid
+
+    # The client sends only the new message. The full history is sent only to resync after a mismatch.
+    chat_id, message = data.get("chat_id"), data.get("message", {})
+    if not chat_id or chat_id == "new":
+        chat_id, history = f"chat-{int(time.time() * 1000)}", []
+    elif "history" in data:
+        history = data["history"]
+    else:
+        history = get_conversation_history(chat_id)
+        if len(history) != data.get("history_length", 0):
+            print(f"[INFO] Chat {chat_id} is out of sync with the client, asking for the full history.")
+            socketio.emit('history_mismatch', {'turn_id': turn_id}, room=sid)
+            return
+    history = history + [message]
+    data = {**data, "chat_id": chat_id, "history": history}
+
+    try: is_backend_trial = check_backend_available(turn_id)
+    except BackendUnavailable as e:
+        socketio.emit('error', {'error': str(e), 'turn_id': turn_id}, room=sid)
+        return
+
+    options, uncaptioned = None, []
+    try: # Everything after claiming a backend trial runs in here, so the finally always releases it
+        if data.get("speculative"): register_speculative_turn(sid, turn_id, message.get("content", ""))
+        options = build_llm_options(llm_options)
+        messages, uncaptioned = prepare_messages(data, options, model, keep_alive)
+        settings = load_settings()
+        main_model = model
+        model, route_reason = route_model(main_model, data.get("fast_model", settings.get("fast_model", "")), messages, settings.get("routing_rules", DEFAULT_ROUTING_RULES))
+        if route_reason != "routing off": print(f"[ROUTER] Model: {model} | Reason: {route_reason}")
+        cache_key = response_cache_key(model, messages, options) if is_response_cacheable(data, options) else None
+        cached_reply = cache_lookup(cache_key) if cache_key else None
+        data = {**data, "cache_audio": cache_key is not None}
+        reused_prompt_tokens = check_prompt_prefix(sid, model, options, messages, "Reply") if cached_reply is None else None
     
-    messages = [{"role": "system", "content": system_message}]
-    for msg in history:
-        ollama_msg = {"role": msg["role"], "content": msg.get("content", "")}
-        if msg.get("images"): ollama_msg["images"] = [img.split(',', 1)[1] for img in msg["images"]]
-        messages.append(ollama_msg)
-    
-    options = {
-        "num_ctx": int(llm_options.get("num_ctx", DEFAULT_NUM_CTX)), 
-		"temperature": float(llm_options.get("temperature", 1.0)),
-		"top_p": float(llm_options.get("top_p", DEFAULT_TOP_P)),
-    }
+        # --- START: Print parameters to terminal ---
+        print("\n--- Applying Parameters ---")
+        print(f"Model: {model}")
     
-    # --- START: Print parameters to terminal ---
-    print("\n--- Applying Parameters ---")
-    print(f"Model: {model}")
-    
-    print("\n[Voice Settings]")
-    print(f"TTS Enabled: {tts_enabled}")
-    print(f"Language: {data.get('tts_lang')}")
-    print(f"Voice: {data.get('tts_voice')}")
-    print(f"Speed: {data.get('tts_speed')}")
-
-    print("\n[LLM Parameters]")
-    for key, value in options.items():
-        print(f"{key}: {value}")
-    print("---------------------------\n")
-    # --- END: Print parameters to terminal ---
-
-    try:
-        response_stream = ollama.chat(model=model, messages=messages, stream=True, options=options)
+        print("\n[Voice Settings]")
+        print(f"TTS Enabled: {tts_enabled}")
+        print(f"Language: {data.get('tts_lang')}")
+        print(f"Voice: {data.get('tts_voice')}")
+        print(f"Speed: {data.get('tts_speed')}")
+
+        print("\n[LLM Parameters]")
+        for key, value in options.items():
+            print(f"{key}: {value}")
+        print("---------------------------\n")
+        # --- END: Print parameters to terminal ---
+
+        token_batch = new_token_batch()
+        if cached_reply is not None:
+            print("[CACHE] Replaying a cached reply.")
+            response_stream = replay_cached_reply(sid, turn_id, cached_reply)
+        else:
+            response_stream = stream_chat(sid, turn_id, model, messages, options, keep_alive, token_batch["window"] or None)
         full_response, sentence_buffer = "", ""
-        final_chunk = None
+        final_chunk = first_token_at = first_sentence_at = None
         for chunk in response_stream:
-            if session.get('stop_generation'): break
+            if is_generation_stopped(sid, turn_id) or is_turn_rejected(sid, turn_id): break
+            if chunk.get("idle"): # The model paused, so the held text has waited a whole window
+                flush_token_batch(token_batch, sid, turn_id, force=True)
+                continue
             if chunk.get("done"):
                 final_chunk = chunk
+                flush_token_batch(token_batch, sid, turn_id, force=True)
+                if sentence_buffer.strip(): first_sentence_at = first_sentence_at or time.perf_counter()
                 if sentence_buffer.strip() and tts_enabled == "On": process_sentence(sentence_buffer, data)
                 break
             token = chunk['message']['content']
-            full_response += token; sentence_buffer += token
-            socketio.emit('llm_token', {'token': token}, room=request.sid); socketio.sleep(0)
+            if token and first_token_at is None: first_token_at = time.perf_counter()
+            full_response += token; sentence_buffer += token; token_batch["text"] += token
+            flush_token_batch(token_batch, sid, turn_id)
             complete_sentences = split_into_sentences(sentence_buffer)
             if len(complete_sentences) > 1:
+                first_sentence_at = first_sentence_at or time.perf_counter()
+                flush_token_batch(token_batch, sid, turn_id, force=True)
                 for sentence in complete_sentences[:-1]:
                     if tts_enabled == "On": process_sentence(sentence, data)
                 sentence_buffer = complete_sentences[-1]
             elif len(complete_sentences) == 1 and sentence_buffer.endswith(('.', '!', '?')):
+                first_sentence_at = first_sentence_at or time.perf_counter()
+                flush_token_batch(token_batch, sid, turn_id, force=True)
                 if tts_enabled == "On": process_sentence(complete_sentences[0], data)
                 sentence_buffer = ""
+        response_stream.close() # Cancels the generation task if the loop ended early
+        flush_token_batch(token_batch, sid, turn_id, force=True)
         
-        if final_chunk:
+        if final_chunk and cache_key and cached_reply is None and not is_turn_rejected(sid, turn_id): cache_store(cache_key, full_response)
+        metrics = build_turn_metrics(model, final_chunk, received_at, first_token_at, first_sentence_at, time.perf_counter()) if final_chunk else None
+        if metrics: metrics["estimated_reused_prompt_tokens"] = reused_prompt_tokens
+        if metrics and not is_turn_rejected(sid, turn_id): recent_turn_metrics.append(metrics)
+        if final_chunk and not final_chunk.get("cached"):
             prompt_tokens = final_chunk.get('prompt_eval_count', 0)
             completion_tokens = final_chunk.get('eval_count', 0)
             total_tokens = prompt_tokens + completion_tokens
+            prompt_eval_ms = (final_chunk.get('prompt_eval_duration') or 0) / 1e6
 			
             print()
             print(f"[STATS] Prompt Tokens:     {prompt_tokens}")
             print(f"[STATS] Completion Tokens: {completion_tokens}")
             print(f"[STATS] Total Tokens:      {total_tokens}")
+            print(f"[STATS] Prompt Eval Time:  {prompt_eval_ms:.0f} ms")
+            print(f"[STATS] Time to First Token:    {metrics['ttft_ms']} ms | Time to First Sentence: {metrics['time_to_first_sentence_ms']} ms")
+            print(f"[STATS] Prompt Speed: {metrics['prompt_tokens_per_sec']} tok/s | Generation Speed: {metrics['generation_tokens_per_sec']} tok/s")
+            if metrics["cold_load"]: print(f"[STATS] Cold load: the model took {metrics['load_ms']} ms to load for this turn.")
             print()
 
-        socketio.emit('chat_end', {'final_message': full_response}, room=request.sid)
+            record_model_speed(model, final_chunk)
+            if model != main_model:
+                actual = ((final_chunk.get('prompt_eval_duration') or 0) + (final_chunk.get('eval_duration') or 0)) / 1e9
+                estimate = estimate_reply_seconds(main_model, prompt_tokens, completion_tokens)
+                if estimate is not None: print(f"[ROUTER] {model} took {actual:.2f}s. {main_model} would have taken about {estimate:.2f}s (saved {estimate - actual:.2f}s).")
+
+            # Ollama now has this conversation, including the reply, in its prompt cache
+            cached_messages = messages + [{"role": "assistant", "content": canonical_text(full_response)}]
+            prefilled_prompts[sid] = prompt_key(model, cached_messages, options)
+            remember_prompt(sid, model, options, cached_messages)
+
+        save_turn_when_confirmed(sid, turn_id, lambda final_text: save_conversation_turn(chat_id, history, full_response, data.get("settings"), final_text, metrics))
+        emit_turn_event('chat_end', {'final_message': full_response, 'turn_id': turn_id, 'chat_id': chat_id, 'metrics': metrics}, sid)
+    except (GenerationQueueFull, BackendUnavailable) as e:
+        emit_turn_event('error', {'error': str(e), 'turn_id': turn_id}, sid)
     except Exception as e:
         print(f"[ERROR] Chat handler error: {e}", file=sys.stderr)
-        socketio.emit('error', {'error': 'An error occurred with the AI model.'}, room=request.sid)
+        emit_turn_event('error', {'error': 'An error occurred with the AI model.', 'turn_id': turn_id}, sid)
+    finally:
+        finish_speculative_turn(sid, turn_id)
+        if is_backend_trial: release_backend_trial(turn_id)
+    # Captions are made after the reply so they don't slow it down
+    start_image_captioning(data, uncaptioned, model, options, keep_alive, sid)
 
 def process_sentence(sentence, request_data):
+    # Skip synthesis once the user has stopped or interrupted the reply
+    if is_generation_stopped(request.sid, request_data.get("turn_id")) or is_turn_rejected(request.sid, request_data.get("turn_id")): return
     sentence = clean_text(sentence)
     if not sentence: return
 	
     #print(f"[TTS] Generating audio for: \"{sentence}\"")
     tts_voice = request_data.get("tts_voice"); tts_speed = request_data.get("tts_speed"); tts_lang = request_data.get("tts_lang")
+    audio_key = audio_cache_key(sentence, tts_voice, tts_speed, tts_lang) if request_data.get("cache_audio") else None
+    audio_base64 = cache_lookup(audio_key) if audio_key else None
+    if audio_base64:
+        emit_turn_event('tts_audio_chunk', {'audioData': audio_base64, 'turn_id': request_data.get("turn_id")}, request.sid)
+        return
     try:
         lang_map = {"zh": "cmn", "fr": "fr-fr"}; kokoro_lang = lang_map.get(tts_lang, tts_lang)
         samples, sample_rate = kokoro.create(text=sentence, voice=tts_voice, speed=float(tts_speed), lang=kokoro_lang)
         buffer = io.BytesIO()
         sf.write(buffer, samples, sample_rate, format="WAV"); buffer.seek(0)
         audio_base64 = base64.b64encode(buffer.read()).decode("utf-8")
-        socketio.emit('tts_audio_chunk', {'audioData': audio_base64}, room=request.sid)
+        if audio_key: cache_store(audio_key, audio_base64)
+        emit_turn_event('tts_audio_chunk', {'audioData': audio_base64, 'turn_id': request_data.get("turn_id")}, request.sid)
     except Exception as e:
         print(f"[ERROR] TTS generation failed for sentence '{sentence}': {e}", file=sys.stderr)
 
 
 if __name__ == "__main__":
     try:
-        print(f"[INFO] Checking for selected model: '{OLLAMA_MODEL}'")
-        ollama.show(OLLAMA_MODEL)
+        print(f"[INFO] Checking for selected model: '{OLLAMA_MODEL}' ({llm_backend.name} backend)")
+        llm_backend.check_model(OLLAMA_MODEL)
         print("[INFO] Model found.")
     except Exception:
-        print(f"[ERROR] Could not connect to Ollama or find model '{OLLAMA_MODEL}'.", file=sys.stderr)
+        print(f"[ERROR] Could not connect to the {llm_backend.name} backend or find model '{OLLAMA_MODEL}'.", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        start_stt_workers(user_settings.get("whisper_model", WHISPER_MODEL))
+    except Exception as e:
+        print(f"[ERROR] Failed to load Whisper model: {e}", file=sys.stderr)
         sys.exit(1)
+
+    start_model_preloader(user_settings)
+    start_model_registry()
+    start_health_monitor()
+    start_generation_loop()
+    migrate_inline_images()
 		
     import webbrowser, threading
     server_url = "http://127.0.0.1:5000"
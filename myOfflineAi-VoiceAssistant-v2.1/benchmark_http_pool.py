@@ -0,0 +1,49 @@
+"""
+Measures the connection setup time saved by app.py's pooled HTTP clients.
+
+Start Ollama, then run:  python benchmark_http_pool.py [rounds] [calls_per_turn]
+
+Each round sends GET /api/version twice: once with a new client (a new TCP connection, as
+before the pool) and once with a shared keep-alive client (as app.py does now). The difference
+is the setup time saved per call. A voice turn makes about two backend calls (the prompt
+prefill and the reply stream), so the saving per turn is shown for calls_per_turn calls.
+"""
+import statistics
+import sys
+import time
+
+import httpx
+
+OLLAMA_URL = "http://127.0.0.1:11434/api/version"
+
+
+def time_call(client):
+    start = time.perf_counter()
+    client.get(OLLAMA_URL).raise_for_status()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    calls_per_turn = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    fresh, pooled = [], []
+    with httpx.Client() as shared:
+        time_call(shared) # Opens the pooled connection
+        for _ in range(rounds):
+            with httpx.Client() as client: fresh.append(time_call(client))
+            pooled.append(time_call(shared))
+
+    fresh_ms, pooled_ms = statistics.median(fresh), statistics.median(pooled)
+    print(f"Rounds: {rounds}")
+    print(f"New connection per call: median {fresh_ms:.3f} ms")
+    print(f"Pooled connection:       median {pooled_ms:.3f} ms")
+    print(f"Saved per call:          {fresh_ms - pooled_ms:.3f} ms")
+    print(f"Saved per turn:          {(fresh_ms - pooled_ms) * calls_per_turn:.3f} ms ({calls_per_turn} calls)")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except httpx.HTTPError as e:
+        print(f"[ERROR] Could not reach Ollama at {OLLAMA_URL}: {e}", file=sys.stderr)
+        sys.exit(1)
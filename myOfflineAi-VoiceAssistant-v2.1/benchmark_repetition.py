@@ -0,0 +1,92 @@
+"""
+Checks app.py's has_repeated_phrases against the regex it replaced.
+
+Run:  python benchmark_repetition.py [max_chars]
+
+1. Detection: every transcript in repetition_corpus.json is checked with both. Hallucinated transcripts
+   must be flagged and normal ones must not. The script fails if the detector misses a transcript the
+   old regex flagged.
+2. Runtime: both are timed on adversarial inputs of growing length up to max_chars (default 20000).
+   The old regex is only timed up to OLD_REGEX_MAX_CHARS, since it takes seconds beyond that.
+
+The detector is read from app.py without importing it, so no models are loaded.
+"""
+import ast
+import json
+import os
+import random
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OLD_REGEX_MAX_CHARS = 5000
+
+
+def load_detector():
+    with open(os.path.join(HERE, "app.py"), encoding="utf-8") as f: source = f.read()
+    node = next(n for n in ast.parse(source).body if isinstance(n, ast.FunctionDef) and n.name == "has_repeated_phrases")
+    namespace = {}
+    exec(ast.get_source_segment(source, node), namespace)
+    return namespace["has_repeated_phrases"]
+
+
+def old_has_repeated_phrases(text):
+    return bool(re.search(r"(.{10,})(\s*\1){2,}", text))
+
+
+def thue_morse(n):
+    # Contains no phrase repeated three times in a row, so every check runs to the end
+    return "".join("ab"[bin(i).count("1") % 2] for i in range(n))
+
+
+def adversarial_inputs(length):
+    rng = random.Random(length)
+    words = " ".join(rng.choice(["alpha", "beta", "gamma", "delta", "epsilon"]) for _ in range(length // 5))
+    letters = "".join(rng.choice("ab ") for _ in range(length))
+    return {"Thue-Morse": thue_morse(length), "Spaced Thue-Morse": " ".join(thue_morse(length // 2)),
+            "Random words": words[:length], "Random letters": letters, "Single character": "a" * length}
+
+
+def time_call(fn, text):
+    start = time.perf_counter()
+    fn(text)
+    return time.perf_counter() - start
+
+
+def check_corpus(detect):
+    with open(os.path.join(HERE, "repetition_corpus.json"), encoding="utf-8") as f: corpus = json.load(f)
+    failures = 0
+    for label, expected in (("hallucinated", True), ("normal", False)):
+        new_hits = old_hits = 0
+        for text in corpus[label]:
+            new, old = detect(text), old_has_repeated_phrases(text)
+            new_hits += new; old_hits += old
+            if old and not new:
+                failures += 1
+                print(f"  MISSED (old regex flags it): {text!r}")
+            elif new != expected:
+                print(f"  {'Not flagged' if expected else 'Flagged'} ({label}): {text!r}")
+        print(f"{label.capitalize()}: {new_hits}/{len(corpus[label])} flagged (old regex: {old_hits})")
+    return failures
+
+
+def main():
+    max_chars = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    detect = load_detector()
+    failures = check_corpus(detect)
+
+    print(f"\n{'Input':<18} {'Chars':>7} {'Detector':>10} {'Old regex':>10}")
+    length = 1250
+    while length <= max_chars:
+        for name, text in adversarial_inputs(length).items():
+            old = f"{time_call(old_has_repeated_phrases, text):.3f}s" if length <= OLD_REGEX_MAX_CHARS else "skipped"
+            print(f"{name:<18} {length:>7} {time_call(detect, text):>9.3f}s {old:>10}")
+        length *= 2
+    if failures:
+        print(f"\n[ERROR] The detector missed {failures} transcript(s) the old regex flagged.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()